@@ -0,0 +1,241 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from main import Processor, RelationalQueryProcessor, TriplestoreQueryProcessor
+from main import GenericQueryProcessor
+from models.main_models import Collection, Manifest
+
+# asyncio counterparts of the query processors in main.py
+# every get method is awaitable: the SQLite reads and the SPARQL requests
+# run on a pool of `max_workers` threads owned by the processor, so that
+# they never block the event loop and many lookups can be awaited together
+# e.g.
+#   rel = AsyncRelationalQueryProcessor()
+#   rel.setDbPathOrUrl("relational.db")
+#   gen = AsyncGenericQueryProcessor()
+#   gen.addQueryProcessor(rel)
+#   annotations = await asyncio.gather(*[gen.getAnnotationsToCanvas(c) for c in canvases])
+# the collections and manifests are returned with their items already loaded
+# on the pool, since getItems() would otherwise query the stores on the event loop
+
+
+def _offloaded(name):
+    # it creates an awaitable version of the method `name` of the wrapped processor
+    async def method(self, *args, **kwargs):
+        return await self._run(name, *args, **kwargs)
+    method.__name__ = name
+    method.__qualname__ = name
+    return method
+
+
+def _offloaded_eager(name):
+    # like _offloaded, for the methods returning collections or manifests:
+    # their items are loaded on the thread pool (lazy=False), since loading
+    # them later with getItems() would query the stores on the event loop
+    async def method(self, *args, lazy=False, **kwargs):
+        return await self._run(name, *args, lazy=lazy, **kwargs)
+    method.__name__ = name
+    method.__qualname__ = name
+    return method
+
+
+def _load_items(result):
+    # it loads the items of the collections and manifests in a result (an object,
+    # or a list or a dictionary of them), and those of the manifests of the collections
+    if isinstance(result, dict):
+        values = result.values()
+    else:
+        values = result if isinstance(result, list) else [result]
+    for value in values:
+        if isinstance(value, (Collection, Manifest)):
+            for item in value.getItems():
+                if isinstance(item, Manifest):
+                    item.getItems()
+    return result
+
+
+def _offloaded_loaded(name):
+    # like _offloaded, for the methods which may return collections or manifests:
+    # their items are loaded on the thread pool too
+    async def method(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = partial(getattr(self.processor, name), *args, **kwargs)
+        return await loop.run_in_executor(self._executor, lambda: _load_items(call()))
+    method.__name__ = name
+    method.__qualname__ = name
+    return method
+
+
+def _offloaded_iter(name):
+    # it creates an asynchronous generator from the generator method `name` of
+    # the wrapped processor, each chunk being read (with the items of the
+    # collections and manifests in it) on the thread pool
+    async def method(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        chunks = getattr(self.processor, name)(*args, **kwargs)
+        end = object()
+        while True:
+            chunk = await loop.run_in_executor(self._executor,
+                                               lambda: _load_items(next(chunks, end)))
+            if chunk is end:
+                return
+            yield chunk
+    method.__name__ = name
+    method.__qualname__ = name
+    return method
+
+
+class AsyncProcessor(object):
+    # this is the base class for the asynchronous processors,
+    # it wraps a synchronous processor and runs its methods on a thread pool
+
+    def __init__(self, processor, max_workers=32):
+        self.processor = processor
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=type(self).__name__)
+
+    def getDbPathOrUrl(self):
+        return self.processor.getDbPathOrUrl()
+
+    def setDbPathOrUrl(self, path_url):
+        return self.processor.setDbPathOrUrl(path_url)
+
+    async def _run(self, name, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        method = getattr(self.processor, name)
+        return await loop.run_in_executor(self._executor, partial(method, *args, **kwargs))
+
+    def getStats(self):
+        return self.processor.getStats()
+
+    def resetStats(self):
+        return self.processor.resetStats()
+
+    def setCallback(self, callback):
+        return self.processor.setCallback(callback)
+
+    def setSlowQueryThreshold(self, seconds, size=100):
+        return self.processor.setSlowQueryThreshold(seconds, size)
+
+    def getSlowQueries(self):
+        return self.processor.getSlowQueries()
+
+    def close(self):
+        # it closes the wrapped processor and stops the thread pool
+        self._executor.shutdown(wait=False)
+        return self.processor.close()
+
+
+class AsyncRelationalQueryProcessor(AsyncProcessor):
+
+    def __init__(self, max_workers=32):
+        super().__init__(RelationalQueryProcessor(), max_workers)
+
+    getAllAnnotations = _offloaded("getAllAnnotations")
+    getAllImages = _offloaded("getAllImages")
+    getAnnotationsWithBody = _offloaded("getAnnotationsWithBody")
+    getAnnotationsWithBodyAndTarget = _offloaded("getAnnotationsWithBodyAndTarget")
+    getAnnotationsWithTarget = _offloaded("getAnnotationsWithTarget")
+    getEntitiesWithCreator = _offloaded("getEntitiesWithCreator")
+    getEntitiesWithTitle = _offloaded("getEntitiesWithTitle")
+    getEntityById = _offloaded("getEntityById")
+    getEntitiesByIds = _offloaded("getEntitiesByIds")
+    getMetadataByIds = _offloaded("getMetadataByIds")
+    getAnnotationsWithTargets = _offloaded("getAnnotationsWithTargets")
+    getAnnotationsWithBodies = _offloaded("getAnnotationsWithBodies")
+    searchTitles = _offloaded("searchTitles")
+    searchLabels = _offloaded("searchLabels")
+    hasContainment = _offloaded("hasContainment")
+    getDescendants = _offloaded("getDescendants")
+    getAnnotationsToDescendants = _offloaded("getAnnotationsToDescendants")
+    iterAllAnnotations = _offloaded_iter("iterAllAnnotations")
+    iterAllImages = _offloaded_iter("iterAllImages")
+    exportSnapshot = _offloaded("exportSnapshot")
+    openSnapshot = _offloaded("openSnapshot")
+
+
+class AsyncTriplestoreQueryProcessor(AsyncProcessor):
+    # SPARQL requests mostly wait on the network, so the pool is larger
+
+    def __init__(self, max_workers=64):
+        super().__init__(TriplestoreQueryProcessor(), max_workers)
+
+    getEntityById = _offloaded("getEntityById")
+    getEntitiesByIds = _offloaded("getEntitiesByIds")
+    getAllCanvases = _offloaded("getAllCanvases")
+    getAllCollections = _offloaded("getAllCollections")
+    getAllManifests = _offloaded("getAllManifests")
+    getCanvasesInCollection = _offloaded("getCanvasesInCollection")
+    getCanvasesInManifest = _offloaded("getCanvasesInManifest")
+    getEntitiesWithLabel = _offloaded("getEntitiesWithLabel")
+    getManifestsInCollection = _offloaded("getManifestsInCollection")
+    getCollectionTree = _offloaded("getCollectionTree")
+    getManifestTree = _offloaded("getManifestTree")
+    iterAllCanvases = _offloaded_iter("iterAllCanvases")
+    iterAllCollections = _offloaded_iter("iterAllCollections")
+    iterAllManifests = _offloaded_iter("iterAllManifests")
+    exportSnapshot = _offloaded("exportSnapshot")
+    openSnapshot = _offloaded("openSnapshot")
+
+
+class AsyncGenericQueryProcessor(AsyncProcessor):
+    # each call runs the corresponding method of a GenericQueryProcessor, which
+    # in turn queries the stores concurrently on a pool of the same size
+
+    def __init__(self, max_workers=64, timeout=None, cache_size=1024, cache_ttl=None):
+        super().__init__(GenericQueryProcessor(max_workers=max_workers, timeout=timeout,
+                                               cache_size=cache_size, cache_ttl=cache_ttl),
+                         max_workers)
+
+    def cleanQueryProcessors(self):
+        return self.processor.cleanQueryProcessors()
+
+    def addQueryProcessor(self, query_processors):
+        # it accepts both synchronous and asynchronous query processors
+        if isinstance(query_processors, (Processor, AsyncProcessor)):
+            query_processors = [query_processors]
+        return self.processor.addQueryProcessor([
+            processor.processor if isinstance(processor, AsyncProcessor) else processor
+            for processor in query_processors])
+
+    def setTimeout(self, seconds, processor=None):
+        if isinstance(processor, AsyncProcessor):
+            processor = processor.processor
+        return self.processor.setTimeout(seconds, processor)
+
+    def getCacheStats(self):
+        return self.processor.getCacheStats()
+
+    def clearCache(self):
+        return self.processor.clearCache()
+
+    getEntityById = _offloaded_loaded("getEntityById")
+    getEntitiesByIds = _offloaded_loaded("getEntitiesByIds")
+    getAnnotationsWithTargets = _offloaded("getAnnotationsWithTargets")
+    getAnnotationsWithBodies = _offloaded("getAnnotationsWithBodies")
+    getAllAnnotations = _offloaded("getAllAnnotations")
+    getAllCanvas = _offloaded("getAllCanvas")
+    getAllImages = _offloaded("getAllImages")
+    getAllManifests = _offloaded_eager("getAllManifests")
+    getAllCollections = _offloaded_eager("getAllCollections")
+    getAnnotationsToCanvas = _offloaded("getAnnotationsToCanvas")
+    getAnnotationsToCollection = _offloaded("getAnnotationsToCollection")
+    getAnnotationsToManifest = _offloaded("getAnnotationsToManifest")
+    getAnnotationsWithBody = _offloaded("getAnnotationsWithBody")
+    getAnnotationsWithBodyAndTarget = _offloaded("getAnnotationsWithBodyAndTarget")
+    getAnnotationsWithTarget = _offloaded("getAnnotationsWithTarget")
+    getCanvasesInCollection = _offloaded("getCanvasesInCollection")
+    getCanvasesInManifest = _offloaded("getCanvasesInManifest")
+    getEntitiesWithCreator = _offloaded_loaded("getEntitiesWithCreator")
+    getEntitiesWithLabel = _offloaded_loaded("getEntitiesWithLabel")
+    getEntitiesWithTitle = _offloaded_loaded("getEntitiesWithTitle")
+    getImagesAnnotatingCanvas = _offloaded("getImagesAnnotatingCanvas")
+    getManifestsInCollection = _offloaded_eager("getManifestsInCollection")
+    searchTitles = _offloaded_loaded("searchTitles")
+    searchLabels = _offloaded_loaded("searchLabels")
+    iterAllAnnotations = _offloaded_iter("iterAllAnnotations")
+    iterAllImages = _offloaded_iter("iterAllImages")
+    iterAllCanvases = _offloaded_iter("iterAllCanvases")
+    iterAllManifests = _offloaded_iter("iterAllManifests")
+    iterAllCollections = _offloaded_iter("iterAllCollections")
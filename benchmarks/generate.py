@@ -0,0 +1,86 @@
+import csv
+import json
+from os import makedirs
+from os.path import join
+from random import Random
+
+# deterministic generator of synthetic data shaped like the files in data/:
+# `collections` collections, each with `manifests` manifests, each with
+# `canvases` canvases, written as one IIIF file with a list of collections,
+# plus one painting annotation for each canvas and metadata for every entity
+# the same arguments (and seed) always produce the same files
+# e.g.
+#   python -m benchmarks.generate out 2 5 100
+
+BASE_URL = "https://example.org/iiif/"
+WORDS = ("commedia", "inferno", "purgatorio", "paradiso", "canzoniere", "vita", "nuova",
+         "rime", "convivio", "monarchia", "epistole", "egloghe", "codice", "foglio",
+         "carta", "piatto", "anteriore", "posteriore", "guardia", "miniatura")
+CREATORS = ("Alighieri, Dante", "Petrarca, Francesco", "Boccaccio, Giovanni",
+            "Doe, John", "Doe, Jane", "Cavalcanti, Guido")
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count)).capitalize()
+
+
+def _label(text):
+    return {"none": [text]}
+
+
+def generate(folder, collections, manifests, canvases, seed=0):
+    # it writes collections.json, annotations.csv and metadata.csv in `folder`
+    # and returns their paths and the number of entities generated
+    rng = Random(seed)
+    makedirs(folder, exist_ok=True)
+    paths = {"collection": join(folder, "collections.json"),
+             "annotations": join(folder, "annotations.csv"),
+             "metadata": join(folder, "metadata.csv")}
+
+    documents = []
+    annotations = []
+    metadata = []
+    for c in range(collections):
+        collection_id = f"{BASE_URL}{c}/collection"
+        collection_title = _words(rng, 3)
+        metadata.append((collection_id, collection_title, "; ".join(rng.sample(CREATORS, 2))))
+        manifest_documents = []
+        for m in range(manifests):
+            manifest_id = f"{BASE_URL}{c}/{m}/manifest"
+            manifest_title = _words(rng, 2)
+            metadata.append((manifest_id, manifest_title, rng.choice(CREATORS)))
+            canvas_documents = []
+            for k in range(canvases):
+                canvas_id = f"{BASE_URL}{c}/{m}/canvas/p{k + 1}"
+                canvas_label = f"{manifest_title} {k + 1:04d} {_words(rng, 1)}.jpg"
+                canvas_documents.append({"id": canvas_id, "type": "Canvas",
+                                         "label": _label(canvas_label)})
+                metadata.append((canvas_id, f"{manifest_title} - {k + 1}", rng.choice(CREATORS)))
+                annotations.append((f"{BASE_URL}{c}/{m}/annotation/p{k + 1:04d}-image",
+                                    f"{BASE_URL}image/{c}-{m}-{k}/full/699,800/0/default.jpg",
+                                    canvas_id, "painting"))
+            manifest_documents.append({"id": manifest_id, "type": "Manifest",
+                                       "label": _label(manifest_title),
+                                       "items": canvas_documents})
+        documents.append({"@context": "http://iiif.io/api/presentation/3/context.json",
+                          "id": collection_id, "type": "Collection",
+                          "label": _label(collection_title), "items": manifest_documents})
+
+    with open(paths["collection"], "w", encoding="utf-8") as f:
+        json.dump(documents, f, ensure_ascii=False, indent=1)
+    for name, header, rows in (("annotations", ("id", "body", "target", "motivation"), annotations),
+                               ("metadata", ("id", "title", "creator"), metadata)):
+        with open(paths[name], "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    counts = {"collections": collections, "manifests": collections * manifests,
+              "canvases": collections * manifests * canvases, "annotations": len(annotations)}
+    return paths, counts
+
+
+if __name__ == "__main__":
+    from sys import argv
+    folder, sizes = argv[1], [int(value) for value in argv[2:5]]
+    print(generate(folder, *sizes))
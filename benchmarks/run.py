@@ -0,0 +1,158 @@
+import json
+import platform
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from main import AnnotationProcessor, MetadataProcessor, CollectionProcessor
+from main import RelationalQueryProcessor, TriplestoreQueryProcessor, GenericQueryProcessor
+from benchmarks.generate import generate, BASE_URL
+
+# benchmark of the uploads and of the GenericQueryProcessor methods on synthetic
+# data of growing size (see generate.py); it runs offline, the triplestore being
+# a local N-Triples file (see TriplestoreQueryProcessor), and saves the timings
+# and the number of round trips to the stores (see Processor.getStats) as JSON,
+# to be compared between runs
+# e.g.
+#   python -m benchmarks.run --scales 1x2x50 2x5x200 --output results.json
+
+
+def _consume(chunks):
+    return [item for chunk in chunks for item in chunk]
+
+
+def queries(ids):
+    # the calls measured, as (name, function of the generic query processor)
+    return [
+        ("getEntityById", lambda g: g.getEntityById(ids["manifest"])),
+        ("getEntitiesByIds", lambda g: g.getEntitiesByIds(ids["canvases"])),
+        ("getAllAnnotations", lambda g: g.getAllAnnotations()),
+        ("getAllCanvas", lambda g: g.getAllCanvas()),
+        ("getAllImages", lambda g: g.getAllImages()),
+        ("getAllManifests", lambda g: g.getAllManifests()),
+        ("getAllManifests(lazy=False)", lambda g: g.getAllManifests(lazy=False)),
+        ("getAllCollections", lambda g: g.getAllCollections()),
+        ("getAllCollections(lazy=False)", lambda g: g.getAllCollections(lazy=False)),
+        ("getAllCollections+getItems", lambda g: [m.getItems() for c in g.getAllCollections()
+                                                  for m in c.getItems()]),
+        ("getAnnotationsToCanvas", lambda g: g.getAnnotationsToCanvas(ids["canvas"])),
+        ("getAnnotationsToCollection", lambda g: g.getAnnotationsToCollection(ids["collection"])),
+        ("getAnnotationsToManifest", lambda g: g.getAnnotationsToManifest(ids["manifest"])),
+        ("getAnnotationsWithBody", lambda g: g.getAnnotationsWithBody(ids["body"])),
+        ("getAnnotationsWithBodyAndTarget",
+         lambda g: g.getAnnotationsWithBodyAndTarget(ids["body"], ids["canvas"])),
+        ("getAnnotationsWithTarget", lambda g: g.getAnnotationsWithTarget(ids["canvas"])),
+        ("getAnnotationsWithTargets", lambda g: g.getAnnotationsWithTargets(ids["canvases"])),
+        ("getCanvasesInCollection", lambda g: g.getCanvasesInCollection(ids["collection"])),
+        ("getCanvasesInManifest", lambda g: g.getCanvasesInManifest(ids["manifest"])),
+        ("getManifestsInCollection", lambda g: g.getManifestsInCollection(ids["collection"])),
+        ("getEntitiesWithCreator", lambda g: g.getEntitiesWithCreator(ids["creator"])),
+        ("getEntitiesWithLabel", lambda g: g.getEntitiesWithLabel(ids["label"])),
+        ("getEntitiesWithTitle", lambda g: g.getEntitiesWithTitle(ids["title"])),
+        ("getImagesAnnotatingCanvas", lambda g: g.getImagesAnnotatingCanvas(ids["canvas"])),
+        ("searchTitles", lambda g: g.searchTitles(ids["title"].split()[0])),
+        ("searchLabels", lambda g: g.searchLabels(ids["label"].split()[0])),
+        ("iterAllAnnotations", lambda g: _consume(g.iterAllAnnotations())),
+        ("iterAllCanvases", lambda g: _consume(g.iterAllCanvases())),
+    ]
+
+
+def _size(result):
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return 0 if result is None else 1
+
+
+def _timed(function, repeat):
+    # it returns the best and mean time of `repeat` calls, and the last result
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        times.append(perf_counter() - start)
+    return min(times), sum(times) / len(times), result
+
+
+def run_scale(folder, collections, manifests, canvases, seed=0, repeat=3):
+    # it generates the data of one scale, uploads it and times every query
+    paths, counts = generate(folder, collections, manifests, canvases, seed)
+    relational = join(folder, "relational.db")
+    graph = join(folder, "graph.nt")
+
+    uploads = {}
+    annotation_processor = AnnotationProcessor()
+    annotation_processor.setDbPathOrUrl(relational)
+    metadata_processor = MetadataProcessor()
+    metadata_processor.setDbPathOrUrl(relational)
+    collection_processor = CollectionProcessor()
+    collection_processor.setDbPathOrUrl(graph)
+    collection_processor.setRelationalDbPath(relational)
+    for name, processor, path in (("AnnotationProcessor", annotation_processor, paths["annotations"]),
+                                  ("MetadataProcessor", metadata_processor, paths["metadata"]),
+                                  ("CollectionProcessor", collection_processor, paths["collection"])):
+        start = perf_counter()
+        success = processor.uploadData(path)
+        uploads[name] = {"seconds": perf_counter() - start, "success": success,
+                         "stats": processor.getUploadStats()}
+
+    relational_processor = RelationalQueryProcessor()
+    relational_processor.setDbPathOrUrl(relational)
+    triple_processor = TriplestoreQueryProcessor()
+    triple_processor.setDbPathOrUrl(graph)
+    # the cache is disabled, so that every call reaches the stores
+    generic = GenericQueryProcessor(cache_size=0)
+    generic.addQueryProcessor([relational_processor, triple_processor])
+
+    # the queries are about the first collection, manifest and canvas
+    ids = {"collection": f"{BASE_URL}0/collection",
+           "manifest": f"{BASE_URL}0/0/manifest",
+           "canvas": f"{BASE_URL}0/0/canvas/p1",
+           "canvases": [f"{BASE_URL}0/0/canvas/p{k + 1}" for k in range(canvases)],
+           "body": f"{BASE_URL}image/0-0-0/full/699,800/0/default.jpg"}
+    sample = generic.getEntityById(ids["manifest"])
+    ids["title"] = sample.getTitle() if sample is not None and sample.getTitle() else "codice"
+    ids["label"] = sample.getLabel() if sample is not None and sample.getLabel() else "codice"
+    ids["creator"] = sample.getCreator()[0] if sample is not None and sample.getCreator() else ""
+
+    results = {}
+    for name, function in queries(ids):
+        relational_processor.resetStats()
+        triple_processor.resetStats()
+        best, mean, result = _timed(lambda: function(generic), repeat)
+        results[name] = {"best_seconds": best, "mean_seconds": mean, "results": _size(result),
+                         "relational_round_trips":
+                             relational_processor.getStats()["round_trips"] // repeat,
+                         "triplestore_round_trips":
+                             triple_processor.getStats()["round_trips"] // repeat}
+    generic.cleanQueryProcessors()
+
+    return {"scale": {"collections": collections, "manifests": manifests, "canvases": canvases},
+            "counts": counts, "uploads": uploads, "queries": results}
+
+
+def main(scales, output, seed=0, repeat=3):
+    report = {"created": datetime.now(timezone.utc).isoformat(),
+              "python": platform.python_version(), "seed": seed, "repeat": repeat,
+              "scales": []}
+    for scale in scales:
+        collections, manifests, canvases = (int(value) for value in scale.split("x"))
+        with TemporaryDirectory() as folder:
+            report["scales"].append(run_scale(folder, collections, manifests, canvases,
+                                              seed, repeat))
+        print(f"{scale}: done")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="benchmark of the uploads and of the queries")
+    parser.add_argument("--scales", nargs="+", default=["1x2x20", "2x5x100"],
+                        help="sizes as COLLECTIONSxMANIFESTSxCANVASES")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    arguments = parser.parse_args()
+    main(arguments.scales, arguments.output, arguments.seed, arguments.repeat)
@@ -1,85 +1,299 @@
 import pandas as pd
 import rdflib
 from models.main_models import *  
-from utils import upload_to_db, create_graph, remove_invalid_char
+from utils import upload_to_db, upload_triples, split_creators
+from utils import iter_iiif_events, iter_collection_triples, CollectionIndexWriter, to_fts_query
+from utils import ResultCache, is_remote, local_graph, sparql_values, iri_or_none
+from utils import forget_local_graph, sparql_select
+from utils import query_signature, result_rows
+from utils import export_database, write_columnar, snapshot_file, find_snapshot_file
+from utils import snapshot_frame, SNAPSHOT_DB, SNAPSHOT_GRAPH, SNAPSHOT_MMAP_SIZE
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import wraps, lru_cache
+from time import monotonic, perf_counter
+from collections import deque
 from sqlite3 import connect
 from pandas import read_sql, concat
-from sparql_dataframe import get
-from json import load
-from rdflib import Graph, URIRef  
-from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore  
+from os.path import join, exists, abspath
+from urllib.request import pathname2url
+from rdflib import Literal, URIRef, Variable
 from rdflib.plugins.sparql import prepareQuery
 
 # https://github.com/comp-data/2022-2023/tree/main/docs/project#uml-of-additional-classes
 
+# the version of the data: it is increased by every successful upload and by
+# every change of database, so that the results cached by the generic query
+# processors are not served once the data they were computed from changed
+_data_version = 0
+_data_version_lock = threading.Lock()
+
+
+def get_data_version():
+    return _data_version
+
+
+def bump_data_version():
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+        return _data_version
+
+
+def instrumented(method):
+    # it makes a method of a processor record the time it takes, the rows it
+    # returns and the round trips to the database it needs (see Processor.getStats)
+    @wraps(method)
+    def instrumented_method(self, *args, **kwargs):
+        return self._measure(method, args, kwargs)
+    return instrumented_method
+
+
 class Processor(object):
     # this is the base class for processors 
     # it includes a variable called `path_url`, 
     # which stores the path or URL of the database
 
+    # every call of an instrumented method is recorded: its time, the rows it
+    # returned, the round trips to the database (SQL statements or SPARQL
+    # requests) and the fingerprints of their text; the records are summed
+    # up by getStats(), passed to the callback set with setCallback(), and
+    # kept in the slow query log if they took at least `slowQueryThreshold` seconds
+
     def __init__(self):
         self.dbPathOrUrl = None
+        self.uploadStats = None
+        self.callback = None
+        self.slowQueryThreshold = None
+        self.slowQueries = deque(maxlen=100)
+        self._instrumentation = threading.local()
+        self._statsLock = threading.Lock()
+        self.resetStats()
 
     def getDbPathOrUrl(self):
         return self.dbPathOrUrl
 
     def setDbPathOrUrl(self, path_url):
         self.dbPathOrUrl = path_url
+        bump_data_version()
+        return True
+
+    def _uploaded(self, stats):
+        # it records the statistics of an upload, None if it failed
+        if stats is not None:
+            self.uploadStats = stats
+            bump_data_version()
+        return stats is not None
+
+    def getUploadStats(self):
+        # it returns the statistics of the last successful upload
+        # (e.g. how many triples and batches were sent), or None
+        return self.uploadStats
+
+    def close(self):
+        # it releases the resources kept open by the processor
+        return True
+
+    def setCallback(self, callback):
+        # it sets a function called with the record of every call
+        # (a dictionary, see _measure), or None to remove it
+        self.callback = callback
+        return True
+
+    def setSlowQueryThreshold(self, seconds, size=100):
+        # the calls taking at least `seconds` (None for none) are kept
+        # in a log of the last `size` of them
+        self.slowQueryThreshold = seconds
+        self.slowQueries = deque(self.slowQueries, maxlen=size)
+        return True
+
+    def getSlowQueries(self):
+        return list(self.slowQueries)
+
+    def resetStats(self):
+        with self._statsLock:
+            self.methodStats = {}
+            self.queryTexts = {}
+            self.roundTrips = 0
         return True
 
+    def getStats(self):
+        # it returns, for each method called, the number of calls, their total,
+        # mean and maximum time, the rows returned and the round trips,
+        # together with the text of the queries sent, by fingerprint
+        with self._statsLock:
+            methods = {name: dict(stats, mean_seconds=stats["seconds"] / stats["calls"])
+                       for name, stats in self.methodStats.items()}
+            return {"processor": type(self).__name__,
+                    "calls": sum(stats["calls"] for stats in methods.values()),
+                    "seconds": sum(stats["seconds"] for stats in methods.values()),
+                    "round_trips": self.roundTrips,
+                    "methods": methods,
+                    "queries": dict(self.queryTexts),
+                    "slow_queries": len(self.slowQueries)}
+
+    def _countRoundTrip(self, query):
+        # it is called by the processors for every request sent to the database
+        # SQLite also reports the statements run inside a request (by the
+        # full-text search and by the triggers), which start with "-- "
+        if query.startswith("-- "):
+            return
+        fingerprint, text = query_signature(query)
+        with self._statsLock:
+            self.roundTrips += 1
+            if fingerprint not in self.queryTexts:
+                self.queryTexts[fingerprint] = {"text": text, "count": 0}
+            self.queryTexts[fingerprint]["count"] += 1
+        record = getattr(self._instrumentation, "current", None)
+        if record is not None:
+            record["round_trips"] += 1
+            if fingerprint not in record["queries"]:
+                record["queries"].append(fingerprint)
+
+    def _childRoundTrips(self):
+        # the round trips made so far by the processors this one relies on
+        return 0
+
+    def _callBefore(self, deadline, method_name, *args):
+        # it calls a method whose requests to the database are abandoned at
+        # `deadline` (a monotonic() time, None for no limit), raising TimeoutError
+        self._instrumentation.deadline = deadline
+        try:
+            return getattr(self, method_name)(*args)
+        except Exception as e:
+            if deadline is not None and monotonic() >= deadline:
+                raise TimeoutError(f"{type(self).__name__}.{method_name} timed out") from e
+            raise
+        finally:
+            self._instrumentation.deadline = None
+
+    def _remaining(self):
+        # the seconds left to the deadline of the current call, None for no limit
+        deadline = getattr(self._instrumentation, "deadline", None)
+        return None if deadline is None else max(0.0, deadline - monotonic())
+
+    def _measure(self, method, args, kwargs):
+        # it calls a method and records the call
+        outer = getattr(self._instrumentation, "current", None)
+        record = {"processor": type(self).__name__, "method": method.__name__,
+                  "round_trips": 0, "queries": [], "rows": 0, "error": None}
+        self._instrumentation.current = record
+        child_round_trips = self._childRoundTrips()
+        start = perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+            record["rows"] = result_rows(result)
+            return result
+        except Exception as e:
+            record["error"] = repr(e)
+            raise
+        finally:
+            record["seconds"] = perf_counter() - start
+            record["round_trips"] += self._childRoundTrips() - child_round_trips
+            self._instrumentation.current = outer
+            if outer is not None:
+                outer["round_trips"] += record["round_trips"]
+                outer["queries"].extend(q for q in record["queries"] if q not in outer["queries"])
+            self._record(record)
+
+    def _record(self, record):
+        with self._statsLock:
+            stats = self.methodStats.get(record["method"])
+            if stats is None:
+                stats = self.methodStats[record["method"]] = {
+                    "calls": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0,
+                    "round_trips": 0, "errors": 0}
+            stats["calls"] += 1
+            stats["seconds"] += record["seconds"]
+            stats["max_seconds"] = max(stats["max_seconds"], record["seconds"])
+            stats["rows"] += record["rows"]
+            stats["round_trips"] += record["round_trips"]
+            stats["errors"] += record["error"] is not None
+        if self.slowQueryThreshold is not None and record["seconds"] >= self.slowQueryThreshold:
+            self.slowQueries.append(record)
+        if self.callback is not None:
+            try:
+                self.callback(record)
+            except Exception as e:
+                print(f"Stats callback failed: {e}")
+
+
+# number of CSV rows read and written at a time by the relational uploads
+CSV_CHUNK_SIZE = 50000
+
 
 class AnnotationProcessor(Processor):
 
-    def uploadData(self, path):
+    def uploadData(self, path, mode="upsert", chunk_size=CSV_CHUNK_SIZE):
         # it accepts the path to a CSV file containing annotations 
         # and uploads them to the relational database
         # it can be invoked whenever there's a requirement 
-        # to add annotations to the database
-        annotations = pd.read_csv(path, keep_default_na=False, dtype='string')
-        return upload_to_db(self.dbPathOrUrl, annotations, "Annotations")
+        # to add annotations to the database: by default the annotations
+        # already stored with the same id are updated ("upsert"), "append"
+        # keeps them as they are and "replace" rewrites the whole table
+        # the file is read in chunks of `chunk_size` rows, all written
+        # in a single transaction
+        annotations = pd.read_csv(path, keep_default_na=False, dtype='string',
+                                  chunksize=chunk_size)
+        return self._uploaded(upload_to_db(self.dbPathOrUrl, annotations, "Annotations", mode))
 
 
 class MetadataProcessor(Processor):
     # it accepts the path to a CSV file containing metadata 
     # and uploads them to the relational database
     # can be invoked whenever there's a requirement 
-    # to add metadata to the database
-    def uploadData(self, path):
-        metadata = pd.read_csv(path, dtype='string', keep_default_na=False)
-        return upload_to_db(self.dbPathOrUrl, metadata, "Metadata")
+    # to add metadata to the database (see AnnotationProcessor for the modes)
+    def uploadData(self, path, mode="upsert", chunk_size=CSV_CHUNK_SIZE):
+        metadata = pd.read_csv(path, dtype='string', keep_default_na=False,
+                               chunksize=chunk_size)
+        return self._uploaded(upload_to_db(self.dbPathOrUrl, metadata, "Metadata", mode))
 
 
 class CollectionProcessor(Processor):
-
-    def __init__(self):
+    # triples are sent to the triplestore in batches of `batch_size`,
+    # one INSERT DATA request per batch instead of one request per triple
+    # if the path of the relational database is set, the labels are also
+    # indexed there for full-text search (see RelationalQueryProcessor.searchLabels)
+    # the triples go to a SPARQL endpoint, or to a local N-Triples file
+    # if the database is a path (see TriplestoreQueryProcessor)
+
+    def __init__(self, batch_size=5000):
         super().__init__()
+        self.batch_size = batch_size
+        self.relationalDbPath = None
+
+    def getRelationalDbPath(self):
+        return self.relationalDbPath
+
+    def setRelationalDbPath(self, path):
+        self.relationalDbPath = path
+        return True
+
+    def getBatchSize(self):
+        return self.batch_size
+
+    def setBatchSize(self, batch_size):
+        if batch_size < 1:
+            return False
+        self.batch_size = batch_size
+        return True
 
     def uploadData(self, path):
         try:
             base_url = "https://github.com/eugeniavd/data_iif/"  
-            new_graph = Graph()
 
-            # uploading json file
-            with open(path, mode='r', encoding="utf-8") as j:
-                json_obj = load(j)
+            # the json file is read incrementally: the triples of each
+            # collection, manifest and canvas are produced while parsing
+            # and sent in batches, so the file is never loaded as a whole
+            with CollectionIndexWriter(self.relationalDbPath) as index:
+                events = index.watch(iter_iiif_events(path))
+                triples = iter_collection_triples(events, base_url)
 
-            # checking the loaded file
-            if type(json_obj) is list:
-                for collection in json_obj:
-                    create_graph(collection, base_url, new_graph)
-            else:
-                create_graph(json_obj, base_url, new_graph)
-
-            # storing the triples 
-            store = SPARQLUpdateStore()
-            endpoint = self.getDbPathOrUrl()
-            store.open((endpoint, endpoint))
-            for triple in new_graph.triples((None, None, None)):
-                store.add(triple)
-            store.close()
-            
-            return True
+                # storing the triples in batches
+                stats = upload_triples(self.getDbPathOrUrl(), triples, self.batch_size)
+            return self._uploaded(stats)
         # error check
         except Exception as e:
             print(f"Upload failed: {str(e)}")
@@ -93,81 +307,215 @@ class QueryProcessor(Processor):
 
 
 class RelationalQueryProcessor(QueryProcessor):
+    # the connections to the database are kept open and reused by the queries,
+    # one per thread, each with a cache of `statement_cache_size` compiled
+    # statements, and they are released by close()
+    # the database of a snapshot (see openSnapshot) is opened read-only
+    # and memory-mapped
+
+    # number of values bound in a single `IN (...)` by the batch lookups
+    in_chunk_size = 500
+
+    def __init__(self, statement_cache_size=512):
+        super().__init__()
+        self.statement_cache_size = statement_cache_size
+        self.readOnly = False
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def setDbPathOrUrl(self, path_url):
+        self.close()
+        self.readOnly = False
+        return super().setDbPathOrUrl(path_url)
+
+    def exportSnapshot(self, folder):
+        # it writes in a folder the snapshot of the database: a compacted copy,
+        # with all its indexes, to be opened with openSnapshot
+        try:
+            export_database(self.dbPathOrUrl, folder)
+            return True
+        except Exception as e:
+            print(f"Snapshot failed: {e}")
+            return False
+
+    def openSnapshot(self, folder):
+        # it queries the database of a snapshot written by exportSnapshot:
+        # nothing is loaded, the file is opened read-only and its pages
+        # are memory-mapped as the queries read them
+        path = join(folder, SNAPSHOT_DB)
+        if not exists(path):
+            return False
+        self.setDbPathOrUrl(path)
+        self.readOnly = True
+        return True
+
+    def _connection(self):
+        # it returns the connection of the current thread, opening it if needed
+        con = getattr(self._local, "connection", None)
+        if con is None:
+            # the connection is only used by this thread, but close()
+            # may be called from another one
+            if self.readOnly:
+                # a snapshot never changes, so there is nothing to lock
+                con = sqlite3.connect("file:" + pathname2url(abspath(self.dbPathOrUrl))
+                                      + "?mode=ro&immutable=1", uri=True,
+                                      check_same_thread=False,
+                                      cached_statements=self.statement_cache_size)
+                con.execute(f"PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}")
+            else:
+                con = sqlite3.connect(self.dbPathOrUrl, check_same_thread=False,
+                                      cached_statements=self.statement_cache_size)
+            con.set_trace_callback(self._countRoundTrip)
+            # a query still running at the deadline of the call is interrupted
+            con.set_progress_handler(self._expired, 10000)
+            self._local.connection = con
+            with self._lock:
+                self._connections.append(con)
+        return con
+
+    def _expired(self):
+        return self._remaining() == 0.0
+
+    def close(self):
+        # it closes the connections opened by all the threads
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+            self._local = threading.local()
+        for con in connections:
+            con.close()
+        return True
     
+    @instrumented
     def getAllAnnotations(self):
      # it returns a data frame containing all annotations from the database    
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            query = "SELECT * FROM annotations"
-            result = pd.read_sql(query, con)
+        con = self._connection()
+        query = "SELECT * FROM annotations"
+        result = pd.read_sql(query, con)
         return result
 
 
+    @instrumented
     def getAllImages(self):
     # it returns a data frame containing all images from the database
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            query = "SELECT body FROM annotations"
-            result = pd.read_sql(query, con)
+        con = self._connection()
+        query = "SELECT body FROM annotations"
+        result = pd.read_sql(query, con)
         return result
 
 
+    def _iterTable(self, table, columns, chunk_size):
+        # it yields data frames with the rows of a table, `chunk_size` at a time,
+        # in the order of their id: each page starts after the last id of
+        # the previous one, so it is found through the primary key
+        # instead of skipping the rows already read
+        if not self._hasTable(table):
+            return
+        con = self._connection()
+        last_id = None
+        while True:
+            if last_id is None:
+                query = f"SELECT {columns} FROM {table} ORDER BY id LIMIT ?"
+                params = (chunk_size,)
+            else:
+                query = f"SELECT {columns} FROM {table} WHERE id > ? ORDER BY id LIMIT ?"
+                params = (last_id, chunk_size)
+            result = pd.read_sql(query, con, params=params)
+            if result.empty:
+                return
+            last_id = result["id"].iloc[-1]
+            yield result
+            if len(result) < chunk_size:
+                return
+
+
+    def iterAllAnnotations(self, chunk_size=1000):
+        # it yields data frames containing all annotations from the database,
+        # `chunk_size` at a time
+        yield from self._iterTable("Annotations", "*", chunk_size)
+
+
+    def iterAllImages(self, chunk_size=1000):
+        # it yields data frames containing all images from the database,
+        # `chunk_size` at a time
+        for result in self._iterTable("Annotations", "id, body", chunk_size):
+            yield result[["body"]]
+
+
+    @instrumented
     def getAnnotationsWithBody(self, body):
     # it returns a data frame containing an annotation with the body as in the input  
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            query = "SELECT * FROM annotations WHERE body = ?"
-            result = pd.read_sql(query, con, params=(body,))
+        con = self._connection()
+        query = "SELECT * FROM annotations WHERE body = ?"
+        result = pd.read_sql(query, con, params=(body,))
         return result
 
 
+    @instrumented
     def getAnnotationsWithBodyAndTarget(self, body, target):
     # it returns a data frame containing an annotations with the body and the target 
     # as in the input      
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            query = "SELECT * FROM annotations WHERE body = ? AND target = ?"
-            result = pd.read_sql(query, con, params=(body, target,))
+        con = self._connection()
+        query = "SELECT * FROM annotations WHERE body = ? AND target = ?"
+        result = pd.read_sql(query, con, params=(body, target,))
         return result
 
 
+    @instrumented
     def getAnnotationsWithTarget(self, target):
     # returns a data frame containing an annotations with the target as in the input    
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            query = "SELECT * FROM annotations WHERE target = ?"
-            result = pd.read_sql(query, con, params=(target,))
+        con = self._connection()
+        query = "SELECT * FROM annotations WHERE target = ?"
+        result = pd.read_sql(query, con, params=(target,))
         return result
 
 
+    @instrumented
     def getEntitiesWithCreator(self, creator):
-    # it returns a data frame containing all entities with the creator as in the input    
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            query = "SELECT * FROM metadata WHERE creator = ?"
-            result = pd.read_sql(query, con, params=(creator,))
+    # it returns a data frame containing all entities with the creator as in the input,
+    # either as the whole creator string or as one of the creators it lists
+    # (through the index of EntityCreators)
+        con = self._connection()
+        query = """
+            SELECT * FROM metadata WHERE creator = ?
+            UNION
+            SELECT metadata.* FROM EntityCreators
+                JOIN metadata ON metadata.id = EntityCreators.entity_id
+                WHERE EntityCreators.creator = ?
+            """
+        result = pd.read_sql(query, con, params=(creator, creator))
         return result
 
 
+    @instrumented
     def getEntitiesWithTitle(self, title):
     # it returns a data frame containing all entities with the title as in the input    
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            query = "SELECT * FROM metadata WHERE title = ?"
-            result = pd.read_sql(query, con, params=(title,))
+        con = self._connection()
+        query = "SELECT * FROM metadata WHERE title = ?"
+        result = pd.read_sql(query, con, params=(title,))
         return result
     
 
+    @instrumented
     def getEntityById(self, id):
         # it returns a dataFrame containing all the entities with the same id
         # as in the input, or an empty dataframe if not found
         if not isinstance(id, str):
             return pd.DataFrame()  
 
-        with sqlite3.connect(self.dbPathOrUrl) as con:
-            # search in the metadata table
-            query = "SELECT * FROM metadata WHERE id = ?"
-            cursor = con.cursor()
-            cursor.execute(query, (id,))
-            metadata_result = cursor.fetchall()
+        con = self._connection()
+        # search in the metadata table
+        query = "SELECT * FROM metadata WHERE id = ?"
+        cursor = con.cursor()
+        cursor.execute(query, (id,))
+        metadata_result = cursor.fetchall()
 
-            # search in the annotations table
-            query = "SELECT * FROM annotations WHERE id = ?"
-            cursor.execute(query, (id,))
-            annotations_result = cursor.fetchall()
+        # search in the annotations table
+        query = "SELECT * FROM annotations WHERE id = ?"
+        cursor.execute(query, (id,))
+        annotations_result = cursor.fetchall()
+        cursor.close()
 
         # combine results from both tables 
         metadata_df = pd.DataFrame(metadata_result, columns=["id", "title", "creator"])
@@ -186,7 +534,198 @@ class RelationalQueryProcessor(QueryProcessor):
         return result
 
 
+    def _selectIn(self, query, values):
+        # it runs a query whose `{}` placeholder is replaced by a list of
+        # parameters, once for every chunk of the (unique) values in input,
+        # and returns the combined results
+        values = list(dict.fromkeys(values))
+        con = self._connection()
+        frames = []
+        for start in range(0, len(values), self.in_chunk_size):
+            chunk = values[start:start + self.in_chunk_size]
+            placeholders = ", ".join("?" for _ in chunk)
+            frames.append(pd.read_sql(query.format(placeholders), con, params=chunk))
+        if not frames:
+            return pd.read_sql(query.format("NULL"), con)
+        return pd.concat(frames, ignore_index=True)
+
+
+    @instrumented
+    def getEntitiesByIds(self, ids):
+        # it returns a data frame containing all the entities (metadata and
+        # annotations) whose id is one of those in the input
+        frames = [self._selectIn(f"SELECT * FROM {table} WHERE id IN ({{}})", ids)
+                  for table in ("Metadata", "Annotations") if self._hasTable(table)]
+        frames = [df for df in frames if not df.empty]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+
+    @instrumented
+    def getMetadataByIds(self, ids):
+        # it returns a data frame containing the metadata of the entities
+        # whose id is one of those in the input
+        # (none if only the annotations were uploaded)
+        if not self._hasTable("Metadata"):
+            return pd.DataFrame(columns=["id", "title", "creator"])
+        return self._selectIn("SELECT * FROM metadata WHERE id IN ({})", ids)
+
+
+    @instrumented
+    def getAnnotationsWithTargets(self, targets):
+        # it returns a data frame containing the annotations whose target
+        # is one of those in the input
+        return self._selectIn("SELECT * FROM annotations WHERE target IN ({})", targets)
+
+
+    @instrumented
+    def getAnnotationsWithBodies(self, bodies):
+        # it returns a data frame containing the annotations whose body
+        # is one of those in the input
+        return self._selectIn("SELECT * FROM annotations WHERE body IN ({})", bodies)
+
+
+    def _hasTable(self, name):
+        cursor = self._connection().execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+        found = cursor.fetchone() is not None
+        cursor.close()
+        return found
+
+
+    @instrumented
+    def searchTitles(self, text, limit=20, offset=0):
+        # it returns a data frame with the entities whose title contains the words
+        # in the input (or words starting with them), the best matches first
+        fts_query = to_fts_query(text)
+        if not fts_query or not self._hasTable("TitleSearch"):
+            return pd.DataFrame(columns=["id", "title", "creator", "score"])
+
+        con = self._connection()
+        query = """
+            SELECT metadata.*, TitleSearch.rank AS score
+            FROM TitleSearch JOIN metadata ON metadata.rowid = TitleSearch.rowid
+            WHERE TitleSearch MATCH ?
+            ORDER BY TitleSearch.rank
+            LIMIT ? OFFSET ?
+            """
+        result = pd.read_sql(query, con, params=(fts_query, limit, offset))
+        return result
+
+
+    @instrumented
+    def searchLabels(self, text, limit=20, offset=0):
+        # it returns a data frame with the collections, manifests and canvases
+        # whose label contains the words in the input (or words starting with them),
+        # the best matches first, with their title and creator when available
+        fts_query = to_fts_query(text)
+        if not fts_query or not self._hasTable("LabelSearch"):
+            return pd.DataFrame(columns=["id", "type", "label", "title", "creator", "score"])
+
+        if self._hasTable("Metadata"):
+            metadata_columns = "metadata.title, metadata.creator"
+            metadata_join = "LEFT JOIN metadata ON metadata.id = Labels.id"
+        else:
+            metadata_columns = "NULL AS title, NULL AS creator"
+            metadata_join = ""
+
+        con = self._connection()
+        query = f"""
+            SELECT Labels.id, Labels.type, Labels.label, {metadata_columns},
+                   LabelSearch.rank AS score
+            FROM LabelSearch JOIN Labels ON Labels.rowid = LabelSearch.rowid
+            {metadata_join}
+            WHERE LabelSearch MATCH ?
+            ORDER BY LabelSearch.rank
+            LIMIT ? OFFSET ?
+            """
+        result = pd.read_sql(query, con, params=(fts_query, limit, offset))
+        return result
+
+
+    def hasContainment(self, entity_id=None):
+        # it tells whether the containment closure of the collections
+        # has been stored (see CollectionProcessor.setRelationalDbPath),
+        # or, given an id, whether the entity with that id is in it: the
+        # collections uploaded without a relational database are not
+        if not self._hasTable("Containment"):
+            return False
+        if entity_id is None:
+            return True
+        cursor = self._connection().execute(
+            "SELECT 1 FROM Containment WHERE ancestor = ? AND descendant = ?",
+            (entity_id, entity_id))
+        found = cursor.fetchone() is not None
+        cursor.close()
+        return found
+
+
+    @instrumented
+    def getDescendants(self, ancestor_id, entity_type=None, depth=None):
+        # it returns a data frame with the manifests and canvases contained,
+        # directly (depth 1) or not, in the entity with the id in the input,
+        # or only those of the type and at the depth in the input, in document order
+        if not self.hasContainment():
+            return pd.DataFrame(columns=["id", "type", "label", "depth", "position"])
+
+        con = self._connection()
+        query = """
+            SELECT Containment.descendant AS id, Labels.type, Labels.label,
+                   Containment.depth, Containment.position
+            FROM Containment JOIN Labels ON Labels.id = Containment.descendant
+            WHERE Containment.ancestor = ? AND Containment.depth > 0
+                  AND (? IS NULL OR Labels.type = ?)
+                  AND (? IS NULL OR Containment.depth = ?)
+            ORDER BY Containment.depth, Containment.position
+            """
+        result = pd.read_sql(query, con,
+                             params=(ancestor_id, entity_type, entity_type, depth, depth))
+        return result
+
+
+    @instrumented
+    def getAnnotationsToDescendants(self, ancestor_id, entity_type=None, include_self=False):
+        # it returns a data frame with the annotations whose target is contained
+        # in the entity with the id in the input (and is of the type in the input,
+        # if any), or is the entity itself if `include_self`, with one query
+        if not self.hasContainment() or not self._hasTable("Annotations"):
+            return pd.DataFrame(columns=["id", "body", "target", "motivation"])
+
+        con = self._connection()
+        query = """
+            SELECT annotations.*
+            FROM Containment
+                JOIN Labels ON Labels.id = Containment.descendant
+                JOIN annotations ON annotations.target = Containment.descendant
+            WHERE Containment.ancestor = ? AND Containment.depth >= ?
+                  AND (Containment.depth = 0 OR ? IS NULL OR Labels.type = ?)
+            ORDER BY Containment.depth, Containment.position
+            """
+        min_depth = 0 if include_self else 1
+        result = pd.read_sql(query, con,
+                             params=(ancestor_id, min_depth, entity_type, entity_type))
+        return result
+
+
+@lru_cache(maxsize=256)
+def prepared_query(query):
+    # it parses a query template once, the same text is then reused
+    # with different bindings
+    return prepareQuery(query)
+
+
 class TriplestoreQueryProcessor(Processor):
+    # the database is either the URL of a SPARQL endpoint or the path of an
+    # N-Triples file: the latter is loaded in an in-process graph, shared
+    # with the CollectionProcessor uploading to the same path, so that the
+    # queries run without going through the network
+
+    # every query is a fixed template whose parameters are variables bound
+    # through _select: the text never changes with the input, so it is parsed
+    # once, and the bound terms sit in the triple patterns, where the store
+    # can look them up in its indexes
+
     SPARQL_PREFIXES = """
         PREFIX schema: <https://schema.org/>
         PREFIX evg: <https://github.com/eugeniavd/data_iif/>
@@ -194,191 +733,722 @@ class TriplestoreQueryProcessor(Processor):
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         PREFIX owl: <http://www.w3.org/2002/07/owl#> 
     """
+    # number of identifiers bound in a single VALUES block by the batch lookups
+    values_chunk_size = 200
 
+    def setDbPathOrUrl(self, path_url):
+        if not is_remote(path_url):
+            try:
+                local_graph(path_url)
+            except Exception as e:
+                print(f"Loading the graph failed: {e}")
+                return False
+        return super().setDbPathOrUrl(path_url)
+
+    def exportSnapshot(self, folder, format="arrow"):
+        # it writes in a folder the collection graph as a columnar file, in the
+        # "arrow" (IPC) or "parquet" format, with the subject, predicate and
+        # object of every triple
+        try:
+            path_url = self.getDbPathOrUrl()
+            if is_remote(path_url):
+                # the type of the objects is lost in the results, so the IRIs
+                # and the literals are read apart
+                query = """
+                    SELECT ?s ?p ?o
+                    WHERE { ?s ?p ?o FILTER(isIRI(?o)) }
+                    """
+                iris = self._select(query)
+                literals = self._select(query.replace("isIRI", "isLiteral"))
+                triples = [(URIRef(s), URIRef(p), URIRef(o)) for s, p, o in
+                           iris.reindex(columns=["s", "p", "o"]).itertuples(index=False, name=None)]
+                triples += [(URIRef(s), URIRef(p), Literal(o)) for s, p, o in
+                            literals.reindex(columns=["s", "p", "o"]).itertuples(index=False, name=None)]
+            else:
+                triples = local_graph(path_url).graph
+            path = snapshot_file(folder, SNAPSHOT_GRAPH, format)
+            write_columnar(snapshot_frame(triples), path)
+            forget_local_graph(path)
+            return True
+        except Exception as e:
+            print(f"Snapshot failed: {e}")
+            return False
+
+    def openSnapshot(self, folder):
+        # it queries the collection graph of a snapshot written by exportSnapshot:
+        # the triples are built from the columns of the file, with no parsing,
+        # in a read-only in-process graph, instead of uploading the collections
+        # to an endpoint again; the graph is still loaded as a whole, in a time
+        # that grows with its size
+        path = find_snapshot_file(folder, SNAPSHOT_GRAPH)
+        if path is None:
+            return False
+        return self.setDbPathOrUrl(path)
+
+    def _query(self, query, initBindings=None):
+        # it runs a SELECT query and returns its results as a data frame:
+        # on the SPARQL endpoint, if the database is a URL, or in process on
+        # the local graph stored in the file, if it is a path
+        path_url = self.getDbPathOrUrl()
+        if is_remote(path_url):
+            return sparql_select(path_url, query, self._remaining())
+        return local_graph(path_url).query(query, initBindings)
+
+    def _select(self, query, bindings=None, modifiers=""):
+        # it runs a query template with its parameters bound: `bindings` maps
+        # the names of the variables to rdflib terms, or to lists of terms
+        # on the local graph the template is prepared once and the terms are bound
+        # with initBindings, elsewhere (and for lists) a VALUES block is added
+        # at the start of the WHERE clause
+        query = TriplestoreQueryProcessor.SPARQL_PREFIXES + query + modifiers
+        bindings = bindings or {}
+        self._countRoundTrip(query)
+        if is_remote(self.getDbPathOrUrl()):
+            return self._query(sparql_values(query, bindings))
+
+        terms = {Variable(name): term for name, term in bindings.items()
+                 if not isinstance(term, list)}
+        lists = {name: term for name, term in bindings.items() if isinstance(term, list)}
+        if lists:
+            return self._query(sparql_values(query, lists), terms)
+        return self._query(prepared_query(query), terms)
+
+    def _page(self, limit, offset, ordered=True):
+        # it returns the solution modifiers selecting a page of the results,
+        # ordered by id so that consecutive pages do not overlap, or in the
+        # order of the store if not `ordered` (e.g. when a page holds them all)
+        if limit is None:
+            return ""
+        page = f"LIMIT {int(limit)} OFFSET {int(offset)}"
+        return "ORDER BY ?id " + page if ordered else page
+
+    @instrumented
     def getEntityById(self, entity_id):
         #it returns a data frame with all the entities matching the input identifier 
-        endpoint = self.getDbPathOrUrl()
-        query = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-            
+        query = """
             SELECT ?id ?type ?label
-            WHERE {{
-                ?entity schema:identifier "{entity_id}" .
-                ?entity schema:identifier ?id .
-                ?entity rdf:type ?type .
-                ?entity rdfs:label ?label .
-                
-            }}
+            WHERE {
+                ?entity schema:identifier ?id ;
+                    rdf:type ?type ;
+                    rdfs:label ?label .
+            }
             """
-        df_sparql = get(endpoint, query, True)
-        df_sparql = pd.DataFrame(df_sparql)
+        df_sparql = self._select(query, {"id": Literal(str(entity_id))})
         return df_sparql
 
 
-    def getAllCanvases(self):
+    @instrumented
+    def getEntitiesByIds(self, ids):
+        #it returns a data frame with all the entities whose identifier is one
+        # of those in the input, asking for `values_chunk_size` of them per query
+        query = """
+            SELECT ?id ?type ?label
+            WHERE {
+                ?entity schema:identifier ?id ;
+                    rdf:type ?type ;
+                    rdfs:label ?label .
+            }
+            """
+        ids = list(dict.fromkeys(ids))
+        frames = []
+        for start in range(0, len(ids), self.values_chunk_size):
+            values = [Literal(str(entity_id))
+                      for entity_id in ids[start:start + self.values_chunk_size]]
+            frames.append(self._select(query, {"id": values}))
+        if not frames:
+            return pd.DataFrame(columns=["id", "type", "label"])
+        return pd.concat(frames, ignore_index=True)
+
+
+    @instrumented
+    def getAllCanvases(self, limit=None, offset=0):
         #it returns a data frame with all canvases from the database
-        endpoint = self.getDbPathOrUrl()
-        query_Canvas = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-
+        # with `limit`, only that many canvases starting from `offset`
+        query_Canvas = """
             SELECT ?id ?label 
-            WHERE {{
+            WHERE {
                 ?s rdf:type evg:Canvas ;
                     schema:identifier ?id ;
                     rdfs:label ?label .
-
-            }}
+            }
             """
-        df_sparql_getAllCanvases = get(endpoint, query_Canvas, True)
-        df_canvases = pd.DataFrame(df_sparql_getAllCanvases)
+        df_canvases = self._select(query_Canvas, {}, self._page(limit, offset))
         return df_canvases
 
     
-    def getAllCollections(self):
+    @instrumented
+    def getAllCollections(self, limit=None, offset=0):
         #it returns a data frame with all collections from the database
-        endpoint = self.getDbPathOrUrl()
-        query_Collection = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-            
+        # with `limit`, only that many collections starting from `offset`
+        query_Collection = """
             SELECT ?id ?label 
-            WHERE {{
+            WHERE {
                 ?s rdf:type evg:Collection ;
                    schema:identifier ?id ;
                    rdfs:label ?label .
-            }}
+            }
             """
-        df_sparql_getAllCollections = get(endpoint, query_Collection, True)
-        df_collections = pd.DataFrame(df_sparql_getAllCollections)
+        df_collections = self._select(query_Collection, {}, self._page(limit, offset))
         return df_collections
 
     
-    def getAllManifests(self):
+    @instrumented
+    def getAllManifests(self, limit=None, offset=0):
         #it returns a data frame with all manifests from the database
-        endpoint = self.getDbPathOrUrl()
-        query_Manifest = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-            
+        # with `limit`, only that many manifests starting from `offset`
+        query_Manifest = """
             SELECT ?id ?label
-            WHERE {{
+            WHERE {
                 ?s rdf:type evg:Manifest ;
-                schema:identifier ?id ;
-                rdfs:label ?label .
-        
-            }}
+                    schema:identifier ?id ;
+                    rdfs:label ?label .
+            }
             """
-        df_sparql_getAllManifests = get(endpoint, query_Manifest, True)
-        df_manifests = pd.DataFrame(df_sparql_getAllManifests)
+        df_manifests = self._select(query_Manifest, {}, self._page(limit, offset))
         return df_manifests
 
     
+    def _iterPages(self, method, chunk_size):
+        # it yields the data frames returned by a method taking a limit and
+        # an offset, `chunk_size` rows at a time, until the results end
+        offset = 0
+        while True:
+            result = method(chunk_size, offset)
+            if not result.empty:
+                yield result
+            if len(result) < chunk_size:
+                return
+            offset += chunk_size
+
+
+    def iterAllCanvases(self, chunk_size=1000):
+        # it yields data frames with all canvases from the database, `chunk_size` at a time
+        yield from self._iterPages(self.getAllCanvases, chunk_size)
+
+
+    def iterAllCollections(self, chunk_size=1000):
+        # it yields data frames with all collections from the database, `chunk_size` at a time
+        yield from self._iterPages(self.getAllCollections, chunk_size)
+
+
+    def iterAllManifests(self, chunk_size=1000):
+        # it yields data frames with all manifests from the database, `chunk_size` at a time
+        yield from self._iterPages(self.getAllManifests, chunk_size)
+
+
+    @instrumented
     def getCanvasesInCollection(self, collection_id):
         #it returns a data frame with all canvases from the collection 
         # with the identifier as in the input
-        endpoint = self.getDbPathOrUrl()
-        query_CanvasInCollection = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-    
+        collection = iri_or_none(collection_id)
+        if collection is None:
+            return pd.DataFrame(columns=["id", "label"])
+        query_CanvasInCollection = """
             SELECT ?id ?label
-            WHERE {{
-                ?collection_id rdf:type evg:Collection ;
-                    evg:items ?manifest_id .
-                ?manifest_id rdf:type evg:Manifest ;
-                    evg:items ?Canvas .
-                ?Canvas schema:identifier ?id ;
-                        rdfs:label ?label .
-
-                FILTER(?collection_id = <{collection_id}> )     
-            }}
+            WHERE {
+                ?collection rdf:type evg:Collection ;
+                    evg:items ?manifest .
+                ?manifest rdf:type evg:Manifest ;
+                    evg:items ?canvas .
+                ?canvas schema:identifier ?id ;
+                    rdfs:label ?label .
+            }
             """                
-        
-        df_sparql_CanvasesInCollection = get(endpoint, query_CanvasInCollection, True)
-        df_canvas_in_collection = pd.DataFrame(df_sparql_CanvasesInCollection)
+        df_canvas_in_collection = self._select(query_CanvasInCollection,
+                                               {"collection": collection})
         return df_canvas_in_collection
 
     
-    def getCanvasesInManifest(self, manifest_id):
+    @instrumented
+    def getCanvasesInManifest(self, manifest_id, limit=None, offset=0, ordered=True):
         #it returns a data frame with all canvases from the manifest  
         # with the identifier as in the input
-        endpoint = self.getDbPathOrUrl()
-        query_CanvasInManifest = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-        
+        # with `limit`, only that many canvases starting from `offset`, by id
+        # or, if not `ordered`, in the order of the store
+        manifest = iri_or_none(manifest_id)
+        if manifest is None:
+            return pd.DataFrame(columns=["id", "label"])
+        query_CanvasInManifest = """
             SELECT ?id ?label
-            WHERE {{
-                ?manifest_id rdf:type evg:Manifest ;
+            WHERE {
+                ?manifest rdf:type evg:Manifest ;
                     evg:items ?id .
                 ?id rdf:type evg:Canvas ;
                     rdfs:label ?label .
-
-                FILTER(?manifest_id = <{manifest_id}> )            
-            }}
+            }
             """
-        df_sparql_CanvasesInManifest = get(endpoint, query_CanvasInManifest, True)
-        df_canvas_in_manifest = pd.DataFrame(df_sparql_CanvasesInManifest)
+        df_canvas_in_manifest = self._select(query_CanvasInManifest, {"manifest": manifest},
+                                             self._page(limit, offset, ordered))
         return df_canvas_in_manifest
 
     
+    @instrumented
     def getEntitiesWithLabel(self, label):
         #it returns a data frame with all entities  
         # with the label as in the input
-        endpoint = self.getDbPathOrUrl()
-        query_EntitiesWLabel = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-            
+        query_EntitiesWLabel = """
             SELECT ?id ?type ?label 
-            WHERE {{
-            ?entity rdfs:label "{label}" .
-            ?entity schema:identifier ?id .
-            ?entity rdf:type ?type .
-            ?entity rdfs:label ?label .
-
-            }}
+            WHERE {
+                ?entity rdfs:label ?label ;
+                    schema:identifier ?id ;
+                    rdf:type ?type .
+            }
             """
-        df_sparql_getEntitiesWLabel= get(endpoint, query_EntitiesWLabel, True)
-        df_entity_with_label = pd.DataFrame(df_sparql_getEntitiesWLabel)
+        df_entity_with_label = self._select(query_EntitiesWLabel, {"label": Literal(str(label))})
         return df_entity_with_label
 
     
-    def getManifestsInCollection(self, collection_id):
+    @instrumented
+    def getManifestsInCollection(self, collection_id, limit=None, offset=0, ordered=True):
         #it returns a data frame with all manifests from the collection 
         # with the identifier as in the input
-        endpoint = self.getDbPathOrUrl()
-        query_ManifestsInCollection = f"""
-            {TriplestoreQueryProcessor.SPARQL_PREFIXES}
-            
+        # with `limit`, only that many manifests starting from `offset`, by id
+        # or, if not `ordered`, in the order of the store
+        collection = iri_or_none(collection_id)
+        if collection is None:
+            return pd.DataFrame(columns=["id", "label"])
+        query_ManifestsInCollection = """
             SELECT ?id ?label
-            WHERE {{
-                ?collection_id rdf:type evg:Collection ;
-                               evg:items ?id .
+            WHERE {
+                ?collection rdf:type evg:Collection ;
+                    evg:items ?id .
                 ?id rdf:type evg:Manifest ;
                     rdfs:label ?label .
-
-                FILTER(?collection_id = <{collection_id}> )     
-            }}                            
+            }                            
             """
-        df_sparql_ManifestsInCollection = get(endpoint, query_ManifestsInCollection, True)
-        df_manifest_in_collection = pd.DataFrame(df_sparql_ManifestsInCollection)
+        df_manifest_in_collection = self._select(query_ManifestsInCollection,
+                                                 {"collection": collection},
+                                                 self._page(limit, offset, ordered))
         return df_manifest_in_collection
 
 
+    @instrumented
+    def getCollectionTree(self, collection_id=None):
+        #it returns a data frame with one row for each canvas of each manifest
+        # of the collections (or of the collection with the identifier as in the input):
+        # collection, collection_label, manifest, manifest_label, canvas, canvas_label
+        # manifests and canvases are empty for collections and manifests without items
+        columns = ["collection", "collection_label", "manifest", "manifest_label",
+                   "canvas", "canvas_label"]
+        bindings = {}
+        if collection_id is not None:
+            bindings["c"] = iri_or_none(collection_id)
+            if bindings["c"] is None:
+                return pd.DataFrame(columns=columns)
+
+        query_CollectionTree = """
+            SELECT ?collection ?collection_label ?manifest ?manifest_label ?canvas ?canvas_label
+            WHERE {
+                ?c rdf:type evg:Collection ;
+                    schema:identifier ?collection ;
+                    rdfs:label ?collection_label .
+                OPTIONAL {
+                    ?c evg:items ?m .
+                    ?m rdf:type evg:Manifest ;
+                        schema:identifier ?manifest ;
+                        rdfs:label ?manifest_label .
+                    OPTIONAL {
+                        ?m evg:items ?cv .
+                        ?cv rdf:type evg:Canvas ;
+                            schema:identifier ?canvas ;
+                            rdfs:label ?canvas_label .
+                    }
+                }
+            }
+            """
+        df_collection_tree = self._select(query_CollectionTree, bindings)
+        return df_collection_tree.reindex(columns=columns)
+
+
+    @instrumented
+    def getManifestTree(self):
+        #it returns a data frame with one row for each canvas of each manifest:
+        # manifest, manifest_label, canvas, canvas_label
+        # canvases are empty for manifests without items
+        query_ManifestTree = """
+            SELECT ?manifest ?manifest_label ?canvas ?canvas_label
+            WHERE {
+                ?m rdf:type evg:Manifest ;
+                    schema:identifier ?manifest ;
+                    rdfs:label ?manifest_label .
+                OPTIONAL {
+                    ?m evg:items ?cv .
+                    ?cv rdf:type evg:Canvas ;
+                        schema:identifier ?canvas ;
+                        rdfs:label ?canvas_label .
+                }
+            }
+            """
+        df_manifest_tree = self._select(query_ManifestTree)
+        return df_manifest_tree.reindex(columns=["manifest", "manifest_label",
+                                                 "canvas", "canvas_label"])
+
+
+# conversion of the data frames returned by the query processors into objects
+# of the model: the objects are built straight from the columns, instead of
+# creating a pandas Series for every row
+
+def _column(df, name):
+    # it returns the values of a column as a list, with None for the missing
+    # values (or for all the rows, if the column is missing)
+    if name not in df.columns:
+        return [None] * len(df)
+    column = df[name]
+    if column.isna().any():
+        column = column.astype(object).where(column.notna(), None)
+    return column.tolist()
+
+
+def _entity_with_metadata(entity_type, entity_id, label, title, creator, loaders=None):
+    # it builds a Canvas, Manifest or Collection, according to the type
+    # (a class name or its URI), or an EntityWithMetadata
+    # `loaders` is a function (type, id) -> loader of the items of a manifest
+    # or a collection (see Manifest), without it they have no items
+    entity_type = str(entity_type).rsplit("/", 1)[-1] if entity_type is not None else None
+    if entity_type == "Canvas":
+        return Canvas(id=entity_id, label=label, title=title, creator=creator)
+    if entity_type in ("Manifest", "Collection"):
+        loader = loaders(entity_type, entity_id) if loaders is not None else None
+        items = None if loader is not None else []
+        container = Manifest if entity_type == "Manifest" else Collection
+        return container(id=entity_id, label=label, items=items, title=title,
+                         creator=creator, loader=loader)
+    return EntityWithMetadata(id=entity_id, label=label, title=title, creator=creator)
+
+
+def annotations_from_frame(df):
+    # it returns the annotations described by a data frame with the columns
+    # id, body, target and motivation
+    # bodies and targets repeated in many annotations share the same object
+    return [Annotation(id=annotation_id, body=Image.shared(body),
+                       target=IdentifiableEntity.shared(target), motivation=motivation)
+            for annotation_id, body, target, motivation in zip(
+                _column(df, "id"), _column(df, "body"),
+                _column(df, "target"), _column(df, "motivation"))]
+
+
+def images_from_frame(df, column="body"):
+    # it returns the images whose ids are in a column of a data frame
+    return [Image.shared(image_id) for image_id in _column(df, column)]
+
+
+def canvases_from_frame(df, metadata=None):
+    # it returns the canvases described by a data frame with the columns
+    # id and label (and optionally title and creator), or taking titles and
+    # creators from a dictionary id -> (title, creators), if given
+    if metadata is not None:
+        return [Canvas(id=canvas_id, label=label, title=metadata.get(canvas_id, (None, []))[0],
+                       creator=metadata.get(canvas_id, (None, []))[1])
+                for canvas_id, label in zip(_column(df, "id"), _column(df, "label"))]
+    return [Canvas(id=canvas_id, label=label, title=title, creator=split_creators(creator))
+            for canvas_id, label, title, creator in zip(
+                _column(df, "id"), _column(df, "label"),
+                _column(df, "title"), _column(df, "creator"))]
+
+
+def entities_from_frame(df, seen=None, loaders=None):
+    # it returns the entities with metadata described by a data frame with
+    # an id column and any of type, label, title and creator, skipping the ids
+    # already in `seen` (which is updated), see _entity_with_metadata for `loaders`
+    if seen is None:
+        seen = set()
+    entities = []
+    for entity_id, entity_type, label, title, creator in zip(
+            _column(df, "id"), _column(df, "type"), _column(df, "label"),
+            _column(df, "title"), _column(df, "creator")):
+        if entity_id not in seen:
+            seen.add(entity_id)
+            entities.append(_entity_with_metadata(entity_type, entity_id, label,
+                                                  title, split_creators(creator), loaders))
+    return entities
+
+
+def entity_from_rows(graph_row, metadata_row, annotation_row, loaders=None):
+    # it builds the identifiable entity described by the rows found
+    # for the same id in the triplestore and in the relational database
+    if annotation_row is not None:
+        return Annotation(
+            id=annotation_row["id"],
+            body=Image.shared(annotation_row["body"]),
+            target=IdentifiableEntity.shared(annotation_row["target"]),
+            motivation=annotation_row["motivation"],
+        )
+    if graph_row is None and metadata_row is None:
+        return None
+
+    entity_id = (graph_row or metadata_row)["id"]
+    label = graph_row["label"] if graph_row is not None else None
+    title = metadata_row.get("title") if metadata_row is not None else None
+    creator = split_creators(metadata_row.get("creator")) if metadata_row is not None else []
+    entity_type = graph_row["type"] if graph_row is not None else None
+    return _entity_with_metadata(entity_type, entity_id, label, title, creator, loaders)
+
+
+def manifests_from_tree(tree, metadata):
+    # it returns the manifests, with their canvases, described by a data frame
+    # with the columns manifest, manifest_label, canvas and canvas_label,
+    # taking titles and creators from a dictionary id -> (title, creators)
+    manifests = []
+    manifest_rows = tree.dropna(subset=["manifest"])
+    for manifest_id, rows in manifest_rows.groupby("manifest", sort=False):
+        canvas_rows = rows.dropna(subset=["canvas"]).drop_duplicates(subset=["canvas"])
+        canvases = []
+        for canvas_id, canvas_label in zip(canvas_rows["canvas"].tolist(),
+                                           canvas_rows["canvas_label"].tolist()):
+            title, creator = metadata.get(canvas_id, (None, []))
+            canvases.append(Canvas(id=canvas_id, label=canvas_label,
+                                   title=title, creator=creator))
+
+        title, creator = metadata.get(manifest_id, (None, []))
+        manifests.append(Manifest(id=manifest_id, label=rows["manifest_label"].iloc[0],
+                                  items=canvases, title=title, creator=creator))
+    return manifests
+
+
+def collections_from_tree(tree, metadata):
+    # it returns the collections, with their manifests and canvases, described
+    # by a data frame as the one of TriplestoreQueryProcessor.getCollectionTree
+    collections = []
+    for collection_id, rows in tree.groupby("collection", sort=False):
+        title, creator = metadata.get(collection_id, (None, []))
+        collections.append(Collection(id=collection_id, label=rows["collection_label"].iloc[0],
+                                      items=manifests_from_tree(rows, metadata),
+                                      title=title, creator=creator))
+    return collections
+
+
+# the columns of the data frames returned, instead of the objects, by the
+# getters of GenericQueryProcessor called with return_type="frame" or "arrow"
+ANNOTATION_COLUMNS = ["id", "body", "target", "motivation"]
+ENTITY_COLUMNS = ["id", "type", "label", "title", "creator"]
+
+
+def concat_frames(frames):
+    # it returns the rows of all the (non-empty) data frames in a single one
+    frames = [frame for frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def frame_of(converter, data):
+    # it returns the columns of the objects `converter` would build from a data
+    # frame, one row per id, instead of the objects themselves
+    if converter is images_from_frame:
+        data = data.rename(columns={"body": "id"})
+        columns = ["id"]
+    elif converter is canvases_from_frame:
+        data = data.assign(type="Canvas")
+        columns = ENTITY_COLUMNS
+    elif converter is annotations_from_frame:
+        columns = ANNOTATION_COLUMNS
+    else:
+        columns = ENTITY_COLUMNS
+    return data.reindex(columns=columns).drop_duplicates(subset=["id"]).reset_index(drop=True)
+
+
+def entities_frame(frames):
+    # it returns one row for each entity described by the data frames returned
+    # by the query processors for some ids: the type and label from the
+    # triplestore together with title and creator from the metadata, or the
+    # columns of the annotations
+    data = concat_frames(frames)
+    if data.empty:
+        return pd.DataFrame(columns=ENTITY_COLUMNS + ANNOTATION_COLUMNS[1:])
+    data = data.reindex(columns=ENTITY_COLUMNS + ANNOTATION_COLUMNS[1:])
+    is_graph = data["type"].notna()
+    is_annotation = data["motivation"].notna()
+    graph = data.loc[is_graph, ["id", "type", "label"]].drop_duplicates(subset=["id"])
+    metadata = data.loc[~is_graph & ~is_annotation, ["id", "title", "creator"]]
+    entities = graph.merge(metadata.drop_duplicates(subset=["id"]), on="id", how="outer")
+    annotations = data.loc[is_annotation, ANNOTATION_COLUMNS].drop_duplicates(subset=["id"])
+    return concat_frames([entities, annotations]).reindex(
+        columns=ENTITY_COLUMNS + ANNOTATION_COLUMNS[1:]).reset_index(drop=True)
+
+
+def to_arrow(frame):
+    # it converts a data frame into a pyarrow table
+    # pyarrow is only needed by return_type="arrow"
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('return_type="arrow" requires pyarrow')
+    return pyarrow.Table.from_pandas(frame, preserve_index=False)
+
+
+RETURN_TYPES = ("objects", "frame", "arrow")
+
+
+def columnar(method):
+    # it adds to a getter of GenericQueryProcessor the argument `return_type`:
+    # "objects" (the default) for the objects of the model, "frame" for a pandas
+    # data frame with their columns or "arrow" for a pyarrow table, built
+    # straight from the results of the query processors
+    @wraps(method)
+    def columnar_method(self, *args, return_type="objects", **kwargs):
+        if return_type not in RETURN_TYPES:
+            raise ValueError(f"return_type must be one of {RETURN_TYPES}")
+        outer = getattr(self._calls, "frames", False)
+        self._calls.frames = return_type != "objects"
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._calls.frames = outer
+        return to_arrow(result) if return_type == "arrow" else result
+    return columnar_method
+
+
+def _cache_key(value):
+    # it turns the lists and sets among the arguments into hashable values
+    if isinstance(value, (list, tuple)):
+        return tuple(_cache_key(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+def _copy_result(result):
+    # it copies the lists and dictionaries of a cached result, so that
+    # the callers cannot change what is in the cache
+    if isinstance(result, list):
+        return list(result)
+    if isinstance(result, dict):
+        return {key: list(value) if isinstance(value, list) else value
+                for key, value in result.items()}
+    if isinstance(result, pd.DataFrame):
+        return result.copy()
+    return result
+
+
+def cached(method):
+    # it makes a method of GenericQueryProcessor return the result stored in
+    # its cache for the same arguments, if the data did not change since then
+    @wraps(method)
+    def cached_method(self, *args, **kwargs):
+        try:
+            key = (method.__name__, _cache_key(args), _cache_key(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return method(self, *args, **kwargs)
+
+        version = get_data_version()
+        found, result = self.cache.get(key, version)
+        if not found:
+            # results missing the answer of a processor that timed out are not stored
+            outer_incomplete = getattr(self._calls, "incomplete", False)
+            self._calls.incomplete = False
+            try:
+                result = method(self, *args, **kwargs)
+                if not self._calls.incomplete:
+                    self.cache.put(key, version, result)
+            finally:
+                self._calls.incomplete = outer_incomplete or self._calls.incomplete
+        return _copy_result(result)
+    return cached_method
+
+
 class GenericQueryProcessor(QueryProcessor):
-    # this variable holds a list of query processors 
+    # `query_processors` holds a list of query processors 
     # each get method calls the corresponding method on all query processors,
     # combines the results, and returns the list of unique objects
-    query_processors = []
+
+    # the query processors are called concurrently, on a pool of at most
+    # `max_workers` threads, so that a cross-store query takes as long as the
+    # slowest store instead of the sum of them; a processor that does not
+    # answer within its timeout (in seconds, None for no limit) is skipped
+    # its call goes on in the background, on the pool, until its request to the
+    # database is abandoned at the same deadline (see Processor._callBefore):
+    # the queries on a local graph cannot be interrupted and run to the end
+
+    # the results are kept in a cache of `cache_size` entries, each valid for
+    # `cache_ttl` seconds (None for no limit) and until the next upload
+
+    # number of items read with one query when the items of a collection
+    # or a manifest are loaded lazily
+    items_page_size = 500
+
+    def __init__(self, max_workers=4, timeout=None, cache_size=1024, cache_ttl=None):
+        super().__init__()
+        self.cache = ResultCache(cache_size, cache_ttl)
+        self._calls = threading.local()
+        self.query_processors = []
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.timeouts = {}
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def setTimeout(self, seconds, processor=None):
+        # it sets the timeout of a query processor, or the default one
+        if processor is None:
+            self.timeout = seconds
+        else:
+            self.timeouts[processor] = seconds
+        return True
+
+    def _getExecutor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="query")
+            return self._executor
+
+    def _fanOut(self, method_name, *args):
+        # it calls a method on all the query processors having it and returns
+        # their results, in the order the processors were added
+        processors = [processor for processor in self.query_processors
+                      if hasattr(processor, method_name)]
+        if len(processors) < 2 or self.max_workers < 2:
+            return [getattr(processor, method_name)(*args) for processor in processors]
+
+        executor = self._getExecutor()
+        start = monotonic()
+        futures = []
+        for processor in processors:
+            timeout = self.timeouts.get(processor, self.timeout)
+            deadline = start + timeout if timeout is not None else None
+            try:
+                future = executor.submit(processor._callBefore, deadline, method_name, *args)
+            except RuntimeError:
+                # the pool has just been shut down by cleanQueryProcessors
+                future = None
+            futures.append((processor, deadline, future))
+
+        results = []
+        for processor, deadline, future in futures:
+            try:
+                if future is None:
+                    results.append(processor._callBefore(deadline, method_name, *args))
+                else:
+                    timeout = max(0, deadline - monotonic()) if deadline is not None else None
+                    results.append(future.result(timeout=timeout))
+            except FutureTimeoutError:
+                if future is not None:
+                    future.cancel()
+                self._calls.incomplete = True
+                print(f"{type(processor).__name__}.{method_name} timed out")
+        return results
 
     def cleanQueryProcessors(self):
         # it cleans the query processors list 
-        # by removing all included query processors 
+        # by removing all included query processors,
+        # after closing the connections they keep open
         success = True
         for processor in self.query_processors:
-            if isinstance(processor, (RelationalQueryProcessor, 
-                                      TriplestoreQueryProcessor)):
-                try:
-                    processor.connection.close()
-                except Exception as e:
-                    print("Operation is failed")
-                    success = False
+            try:
+                processor.close()
+            except Exception as e:
+                print(f"Operation is failed: {e}")
+                success = False
+        self.query_processors = []
+        self.timeouts = {}
+        self.cache.clear()
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
         return success
 
     def addQueryProcessor(self, query_processors):
@@ -393,492 +1463,525 @@ class GenericQueryProcessor(QueryProcessor):
                 raise ValueError("Query_processors are not from our model")
 
         self.query_processors.extend(query_processors)
+        self.cache.clear()
+        return True
+
+    def _childRoundTrips(self):
+        # the round trips of the query processors during a call are counted as
+        # the call's own (approximately, if other calls run at the same time)
+        return sum(processor.roundTrips for processor in self.query_processors)
+
+    def getCacheStats(self):
+        # it returns the hits, misses and size of the result cache
+        return self.cache.stats()
+
+    def clearCache(self):
+        self.cache.clear()
         return True
 
 
+    @instrumented
+    @cached
+    @columnar
     def getEntityById(self, entity_id):
         # it returns an identifiable entity with the same id as in the input
         # or it returns None
-        entity = None
-        for processor in self.query_processors:
-            data = processor.getEntityById(entity_id)
-            if data is not None and not data.empty:
-                if entity is None:
-                    entity = data
+        if self._wantsFrames():
+            return entities_frame(self._fanOut("getEntityById", entity_id))
+        rows = self._rowsById(self._fanOut("getEntityById", entity_id))
+        return entity_from_rows(*[found.get(entity_id) for found in rows],
+                                loaders=self._containerLoader)
+
+
+    @instrumented
+    @cached
+    @columnar
+    def getEntitiesByIds(self, ids):
+        # it returns a dictionary with the ids in the input as keys and
+        # the matching identifiable entities (or None) as values
+        # each query processor is asked for all the ids at once
+        ids = list(dict.fromkeys(ids))
+        if self._wantsFrames():
+            return entities_frame(self._fanOut("getEntitiesByIds", ids))
+        rows = self._rowsById(self._fanOut("getEntitiesByIds", ids))
+        return {entity_id: entity_from_rows(*[found.get(entity_id) for found in rows],
+                                            loaders=self._containerLoader)
+                for entity_id in ids}
+
+
+    def _rowsById(self, frames):
+        # it splits the rows describing entities into those coming from the
+        # triplestore, from the metadata and from the annotations, by id
+        graph_rows = {}
+        metadata_rows = {}
+        annotation_rows = {}
+        for entities_data in frames:
+            for row in entities_data.to_dict("records"):
+                if pd.notna(row.get("type")):
+                    graph_rows.setdefault(row["id"], row)
+                elif pd.notna(row.get("motivation")):
+                    annotation_rows.setdefault(row["id"], row)
                 else:
-                    entity = pd.concat([entity, data], axis=0)
-                    entity = entity.drop_duplicates(subset=["id"])
+                    metadata_rows.setdefault(row["id"], row)
+        return graph_rows, metadata_rows, annotation_rows
 
-                return entity
 
-        return entity              
-    
-    
-    def getAllAnnotations(self):
-        # it returns a list of objects of the class Annotation
-        annotations = []
+    def _wantsFrames(self):
+        # it tells whether the current call must return a data frame (see columnar)
+        return getattr(self._calls, "frames", False)
+
+
+    def _build(self, converter, data):
+        # it returns the objects built by `converter` from a data frame,
+        # or their columns if the current call must return a data frame
+        if self._wantsFrames():
+            return frame_of(converter, data)
+        return converter(data)
 
-        for processor in self.query_processors:
-            try:
-                annotations_data = processor.getAllAnnotations()
-                if not annotations_data.empty:
-                        annotations.extend([
-                        Annotation(
-                        id=annotation["id"],
-                        body=Image(id=annotation["body"]),
-                        target=IdentifiableEntity(id=annotation["target"]),
-                        motivation=annotation["motivation"],
-                    ) for _, annotation in annotations_data.iterrows()
-                ])
-            except AttributeError:
-            # The method getAllAnnotations() is not present in this query processor
-                continue
+
+    def _collect(self, converter, method_name, *args):
+        # it calls a method on the query processors and returns the objects
+        # built by `converter` from all the data frames they return
+        return self._build(converter, concat_frames(self._fanOut(method_name, *args)))
+
+
+    def _annotationsByKey(self, method_name, keys, column):
+        # it calls a batch method of the query processors and groups
+        # the annotations found by the value of `column`
+        # (with a data frame, all the annotations are returned together)
+        keys = list(dict.fromkeys(keys))
+        if self._wantsFrames():
+            return frame_of(annotations_from_frame, concat_frames(self._fanOut(method_name, keys)))
+        annotations = {key: [] for key in keys}
+
+        for annotations_data in self._fanOut(method_name, keys):
+            for key, annotation in zip(_column(annotations_data, column),
+                                       annotations_from_frame(annotations_data)):
+                annotations[key].append(annotation)
 
         return annotations
 
+
+    @instrumented
+    @cached
+    @columnar
+    def getAnnotationsWithTargets(self, target_ids):
+        # it returns a dictionary with the target ids in the input as keys and
+        # the lists of objects of the class Annotation having them as target as values
+        return self._annotationsByKey("getAnnotationsWithTargets", target_ids, "target")
+
+
+    @instrumented
+    @cached
+    @columnar
+    def getAnnotationsWithBodies(self, body_ids):
+        # it returns a dictionary with the body ids in the input as keys and
+        # the lists of objects of the class Annotation having them as body as values
+        return self._annotationsByKey("getAnnotationsWithBodies", body_ids, "body")
+
+
+    @instrumented
+    @cached
+    @columnar
+    def getAllAnnotations(self):
+        # it returns a list of objects of the class Annotation
+        return self._collect(annotations_from_frame, "getAllAnnotations")
+
     
+    @instrumented
+    @cached
+    @columnar
     def getAllCanvas(self):
         # it returns a list of objects of the class Canvas
-        canvases = []
-    
-        for processor in self.query_processors:
-            try:
-                canvases_data = processor.getAllCanvases()
-                if not canvases_data.empty:
-                        canvases.extend([
-                        Canvas(
-                        id=canvas["id"],
-                        label=canvas["label"]
-                    ) for _, canvas in canvases_data.iterrows()
-                ])
-            except AttributeError:
-            # The method getAllCanvases() is not present in this query processor
-                continue
-
-        return canvases
+        return self._collect(canvases_from_frame, "getAllCanvases")
 
 
+    @instrumented
+    @cached
+    @columnar
     def getAllImages(self):
         # it returns a list of objects of the class Image
-        images = []
-    
-        for processor in self.query_processors:
-            try:
-                images_data = processor.getAllImages()
-                if not images_data.empty:
-                        images.extend([
-                        Image(
-                        id=image["body"]
-                    ) for _, image in images_data.iterrows()
-                ])
-            except AttributeError:
-            # The method getAllImages() is not present in this query processor
-                continue
-
-        return images
+        return self._collect(images_from_frame, "getAllImages")
 
 
+    @instrumented
+    @cached
+    @columnar
     def getAnnotationsToCanvas(self, canvas_id):
         # it returns a list of objects of the class Annotation
         # matching with the canvas with id as in the input
-        annotations = []
-
-        for processor in self.query_processors:
-            if hasattr(processor, "getAnnotationsWithTarget"):
-                annotations_data = processor.getAnnotationsWithTarget(canvas_id)
-                if not annotations_data.empty:
-                    annotations.extend([
-                        Annotation(
-                        id=annotation["id"],
-                        body=Image(id=annotation["body"]),
-                        target=IdentifiableEntity(id=annotation["target"]),
-                        motivation=annotation["motivation"],
-                    ) for _, annotation in annotations_data.iterrows()
-                ])
-
-        return annotations
+        return self._collect(annotations_from_frame, "getAnnotationsWithTarget", canvas_id)
 
 
+    @instrumented
+    @cached
+    @columnar
     def getAnnotationsToCollection(self, collection_id):
         # it returns a list of objects of the class Annotation
-        # matching with the collection with id as in the input
-        annotations = []
-
-        for processor in self.query_processors:
-            if hasattr(processor, "getCanvasesInCollection"):
-                canvas_id = []
-                canvas_data = processor.getCanvasesInCollection(collection_id)
-                canvas_id.append(canvas_data['id'])
-                
-                if hasattr(processor, "getAnnotationsWithTarget"):
-                    for id in canvas_id:
-                        annotations_data = processor.getAnnotationsWithTarget(id)
-                        
-                        if not annotations_data.empty:
-                            annotations.extend([
-                            Annotation(
-                            id=annotation["id"],
-                            body=Image(id=annotation["body"]),
-                            target=IdentifiableEntity(id=annotation["target"]),
-                            motivation=annotation["motivation"],
-                        ) for _, annotation in annotations_data.iterrows()
-                    ])
-
-        return annotations
+        # matching with the canvases of the collection with id as in the input
+        return self._annotationsToContainer(collection_id, "getCanvasesInCollection", False)
 
     
+    @instrumented
+    @cached
+    @columnar
     def getAnnotationsToManifest(self, manifest_id):
         # it returns a list of objects of the class Annotation
-        # matching with the manifest with id as in the input
-        manifest_data = pd.DataFrame()
-        for qp in self.query_processors:
-            if "getAnnotationsWithTarget" in dir(qp):
-                manifest = qp.getAnnotationsWithTarget(manifest_id)
-                manifest_data = pd.concat([manifest_data, manifest], ignore_index=True)
-        return [Annotation(
-            id=annotation["id"],
-            motivation=annotation["motivation"],
-            body=Image(id=annotation["body"]),
-            target=IdentifiableEntity(id=annotation["target"]),
-        ) for _, annotation in manifest_data.iterrows()]
-
-
+        # matching with the manifest with id as in the input or its canvases
+        return self._annotationsToContainer(manifest_id, "getCanvasesInManifest", True)
+
+
+    def _annotationsToContainer(self, container_id, canvases_method, include_self):
+        # it returns the annotations to the canvases of a collection or a manifest
+        # (and to the container itself, if `include_self`) with a fixed number of queries:
+        # one to the relational database, if the containment of the container is
+        # stored there, otherwise one to the triplestore for the canvases and
+        # one to each relational database for the annotations to all of them
+        triple_processor, relational_processor = self._findProcessors()
+        if relational_processor is not None and relational_processor.hasContainment(container_id):
+            return self._build(annotations_from_frame, relational_processor.getAnnotationsToDescendants(
+                container_id, "Canvas", include_self))
+
+        targets = [container_id] if include_self else []
+        if triple_processor is not None:
+            targets.extend(_column(getattr(triple_processor, canvases_method)(container_id), "id"))
+        if not targets:
+            return self._build(annotations_from_frame, pd.DataFrame())
+        return self._collect(annotations_from_frame, "getAnnotationsWithTargets", targets)
+
+
+    @instrumented
+    @cached
+    @columnar
     def getAnnotationsWithBody(self, body_id):
         # it returns a list of objects of the class Annotation
         # which has in the body the entity with id as in the input
-        annotations = []
-
-        for processor in self.query_processors:
-            if hasattr(processor, "getAnnotationsWithBody"):
-                annotations_data = processor.getAnnotationsWithBody(body_id)
-                if not annotations_data.empty:
-                    annotations.extend([
-                        Annotation(
-                        id=annotation["id"],
-                        body=Image(id=annotation["body"]),
-                        target=IdentifiableEntity(id=annotation["target"]),
-                        motivation=annotation["motivation"],
-                    ) for _, annotation in annotations_data.iterrows()
-                ])
-
-        return annotations
+        return self._collect(annotations_from_frame, "getAnnotationsWithBody", body_id)
 
     
+    @instrumented
+    @cached
+    @columnar
     def getAnnotationsWithBodyAndTarget(self, body_id, target_id):
         # it returns a list of objects of the class Annotation
         # which has in the body and target the entities with id as in the input
-        annotations = []
-
-        for processor in self.query_processors:
-            if hasattr(processor, "getAnnotationsWithBodyAndTarget"):
-                annotations_data = processor.getAnnotationsWithBodyAndTarget(body_id, target_id)
-                if not annotations_data.empty:
-                    annotations.extend([
-                        Annotation(
-                        id=annotation["id"],
-                        body=Image(id=annotation["body"]),
-                        target=IdentifiableEntity(id=annotation["target"]),
-                        motivation=annotation["motivation"],
-                    ) for _, annotation in annotations_data.iterrows()
-                ])
-
-        return annotations
+        return self._collect(annotations_from_frame, "getAnnotationsWithBodyAndTarget",
+                             body_id, target_id)
 
     
+    @instrumented
+    @cached
+    @columnar
     def getAnnotationsWithTarget(self, target_id):
         # it returns a list of objects of the class Annotation
         # which has in the target the entity with id as in the input
-        annotations = []
-
-        for processor in self.query_processors:
-            if hasattr(processor, "getAnnotationsWithTarget"):
-                annotations_data = processor.getAnnotationsWithTarget(target_id)
-                if not annotations_data.empty:
-                    annotations.extend([
-                        Annotation(
-                        id=annotation["id"],
-                        body=Image(id=annotation["body"]),
-                        target=IdentifiableEntity(id=annotation["target"]),
-                        motivation=annotation["motivation"],
-                    ) for _, annotation in annotations_data.iterrows()
-                ])
-
-        return annotations
+        return self._collect(annotations_from_frame, "getAnnotationsWithTarget", target_id)
 
 
+    @instrumented
+    @cached
+    @columnar
     def getCanvasesInCollection(self, collection_id):
-    # it returns a list of objects of the class Canvas
-    # which are contained in the collection with the same id as in the input 
-        canvases = []
-
-        for processor in self.query_processors:
-            if hasattr(processor, "getCanvasesInCollection"):
-                try:
-                    canvases_data = processor.getCanvasesInCollection(collection_id)
-                    if not canvases_data.empty:
-                        canvases.extend([
-                            Canvas(
-                                id=canvas["id"],
-                                label=canvas.get("label")
-                            ) for _, canvas in canvases_data.iterrows()
-                        ])
-                except AttributeError:
-                # The method getCanvasesInCollection() is not present in this query processor
-                    continue
-
-        return canvases
+        # it returns a list of objects of the class Canvas
+        # which are contained in the collection with the same id as in the input 
+        return self._collect(canvases_from_frame, "getCanvasesInCollection", collection_id)
 
 
+    @instrumented
+    @cached
+    @columnar
     def getCanvasesInManifest(self, manifest_id):
         # it returns a list of objects of the class Canvas
         # which are contained in the manifest with the same id as in the input 
-        canvases = []
-
-        for processor in self.query_processors:
-            if hasattr(processor, "getCanvasesInManifest"):
-                try:
-                    canvases_data = processor.getCanvasesInManifest(manifest_id)
-                    if not canvases_data.empty:
-                        canvases.extend([
-                            Canvas(
-                            id=canvas["id"],
-                            label=canvas.get("label"),
-                        ) for _, canvas in canvases_data.iterrows()
-                        ])
-                except AttributeError:
-                # The method getCanvasesInCollection() is not present in this query processor
-                    continue
-
-        return canvases
+        return self._collect(canvases_from_frame, "getCanvasesInManifest", manifest_id)
 
    
-    def getAllManifests(self):
+    @instrumented
+    @cached
+    @columnar
+    def getAllManifests(self, lazy=True):
         # it returns a list of objects having class Manifest
-        manifests = []
-        relational_processor = None
-    
-        for processor in self.query_processors:
-            try:
-                manifests_data = processor.getAllManifests()
-                if not manifests_data.empty:
-                        manifests.extend([
-                        Manifest(
-                        id=manifest["id"],
-                        label=manifest.get("label"),
-                        title=relational_processor.getEntityById(manifest["id"]).loc[0, "title"],
-                        creator=relational_processor.getEntityById(manifest["id"]).loc[0, "creator"],
-                        items=self.getCanvasesInManifest(manifest["id"]),
-                    ) for _, manifest in manifests_data.iterrows()
-                ])
-            except AttributeError:
-            # The method getAllManifests() is not present in this query processor
-                relational_processor = processor 
-                continue
-
-        return manifests
-
-
+        # with `lazy`, the manifests come from one query to the triplestore and
+        # their canvases are fetched the first time getItems() is called;
+        # otherwise all manifests and canvases come from one query to the triplestore
+        # the metadata come from one query to the relational database
+        # (a data frame has one row per manifest, without the canvases)
+        triple_processor, relational_processor = self._findProcessors()
+        if triple_processor is None:
+            return self._build(entities_from_frame, pd.DataFrame())
+
+        if self._wantsFrames():
+            return self._containersFrame(triple_processor.getAllManifests(), "Manifest")
+        if lazy:
+            return self._lazyManifests(triple_processor.getAllManifests())
+        tree = triple_processor.getManifestTree()
+        metadata = self._metadataOf(relational_processor, tree)
+        return manifests_from_tree(tree, metadata)
+
+
+    @instrumented
+    @cached
+    @columnar
     def getEntitiesWithCreator(self, creator_name):
         # it returns a list of objects of the class Entity With Metadata
         # with the same creator as in the input 
-        entities =[]
-        seen_entity_ids = set()  # to keep track of unique entity IDs
-        triple_processor = None
-
-        for processor in self.query_processors:
-            if "getEntitiesWithCreator" in dir(processor):
-                entities_data = processor.getEntitiesWithCreator(creator_name)
-                for index, entity_row in entities_data.iterrows():
-                    entity_id = entity_row["id"]
-                    if entity_id not in seen_entity_ids:
-                        seen_entity_ids.add(entity_id)
-                        entity_title = entity_row["title"]
-                        entity_creator = entity_row["creator"]
-                        triple_qp = None  # Initialize to None
-                        entity_label = None
-
-                        if triple_qp is not None:
-                            entity_info = triple_processor.getEntityById(entity_id)
-                            if entity_info is not None:
-                                entity_label = entity_info.get("label")
-
-                                 
-                        entity_object = EntityWithMetadata(
-                                id=entity_id,
-                                label=entity_label,
-                                title=entity_title,
-                                creator=entity_creator
-                            )
-                        entities.append(entity_object)            
-
-        return entities
+        return self._collect(self._entities, "getEntitiesWithCreator", creator_name)
 
 
+    @instrumented
+    @cached
+    @columnar
     def getEntitiesWithLabel(self, label):
         # it returns a list of objects of the class Entity With Metadata
         # with the same label as in the input 
-        entities = []
-        seen_entity_ids = set()  # to keep track of unique entity IDs
-        relational_processor = None
-
-        for processor in self.query_processors:
-            if "getEntitiesWithLabel" in dir(processor):
-                entities_data = processor.getEntitiesWithLabel(label)
-                for index, entity_row in entities_data.iterrows():
-                    entity_id = entity_row["id"]
-                    if entity_id not in seen_entity_ids:
-                        seen_entity_ids.add(entity_id)
-                        entity_label = entity_row["label"]
-                        entity_title = None  
-                        entity_creator = None
-
-                    if relational_processor is not None:    
-                        entity_info = relational_processor.getEntityById(entity_id)
-                        if entity_info is not None:
-                            entity_creator = entity_info.get("creator")
-                            entity_title = entity_info.get("title")
-
-                    entity_object = EntityWithMetadata(
-                                id=entity_id,
-                                label=entity_label,
-                                title=entity_title,
-                                creator=entity_creator
-                            )
-                    entities.append(entity_object)            
-
-        return entities        
+        return self._collect(self._entities, "getEntitiesWithLabel", label)
 
 
+    @instrumented
+    @cached
+    @columnar
     def getEntitiesWithTitle(self, title):
         # it returns a list of objects of the class Entity With Metadata
         # with the same title as in the input 
-        entities = []
-        seen_entity_ids = set()  # to keep track of unique entity IDs
-        triple_processor = None
+        return self._collect(self._entities, "getEntitiesWithTitle", title)
 
-        for processor in self.query_processors:
-            if "getEntitiesWithTitle" in dir(processor):
-                entities_data = processor.getEntitiesWithTitle(title)
-                for index, entity_row in entities_data.iterrows():
-                    entity_id = entity_row["id"]
-                    if entity_id not in seen_entity_ids:
-                        seen_entity_ids.add(entity_id)
-                        entity_title = entity_row["title"]
-                        entity_creator = entity_row["creator"]
-                        triple_qp = None  
-                        entity_label = None
-
-                        if triple_qp is not None:
-                            entity_info = triple_processor.getEntityById(entity_id)
-                            if entity_info is not None:
-                                entity_label = entity_info.get("label")
-
-                        entity_object = EntityWithMetadata(
-                                id=entity_id,
-                                label=entity_label,
-                                title=entity_title,
-                                creator=entity_creator
-                            )
-                        entities.append(entity_object)            
-
-        return entities        
+
+    @instrumented
+    @cached
+    @columnar
+    def searchTitles(self, text, limit=20, offset=0):
+        # it returns a list of objects of the class Entity With Metadata
+        # whose title matches the words in the input, the best matches first
+        # `limit` and `offset` select the page of results
+        return self._collect(self._entities, "searchTitles", text, limit, offset)
 
 
+    @instrumented
+    @cached
+    @columnar
+    def searchLabels(self, text, limit=20, offset=0):
+        # it returns a list of objects of the classes Collection, Manifest and Canvas
+        # whose label matches the words in the input, the best matches first
+        # `limit` and `offset` select the page of results
+        return self._collect(self._entities, "searchLabels", text, limit, offset)
+
+
+    @instrumented
+    @cached
+    @columnar
     def getImagesAnnotatingCanvas(self, canvas_id):
         # it returns a list of objects of the class Image
         # with the target  like as in the input
-        images = []
+        return self._collect(images_from_frame, "getAnnotationsWithTarget", canvas_id)
 
+
+    @instrumented
+    @cached
+    @columnar
+    def getManifestsInCollection(self, collection_id, lazy=True):
+        # it returns a list of objects of the class Manifest
+        # which are contained in the collection with the same id as in the input 
+        # with `lazy`, their canvases are fetched the first time getItems() is called;
+        # otherwise the manifests and their canvases come from one query to the triplestore
+        # the metadata come from one query to the relational database
+        # (a data frame has one row per manifest, without the canvases)
+        triple_processor, relational_processor = self._findProcessors()
+        if triple_processor is None:
+            return self._build(entities_from_frame, pd.DataFrame())
+
+        if self._wantsFrames():
+            return self._containersFrame(triple_processor.getManifestsInCollection(collection_id),
+                                         "Manifest")
+        if lazy:
+            return self._lazyManifests(triple_processor.getManifestsInCollection(collection_id))
+        tree = triple_processor.getCollectionTree(collection_id)
+        metadata = self._metadataOf(relational_processor, tree)
+        return manifests_from_tree(tree, metadata)
+
+
+    @instrumented
+    @cached
+    @columnar
+    def getAllCollections(self, lazy=True):
+        # it returns a list of objects of the class Collection
+        # with `lazy`, the collections come from one query to the triplestore and
+        # their manifests are fetched the first time getItems() is called;
+        # otherwise the whole hierarchy comes from one query to the triplestore
+        # the metadata come from one query to the relational database
+        # (a data frame has one row per collection, without the manifests)
+        triple_processor, relational_processor = self._findProcessors()
+        if triple_processor is None:
+            return self._build(entities_from_frame, pd.DataFrame())
+
+        if self._wantsFrames():
+            return self._containersFrame(triple_processor.getAllCollections(), "Collection")
+        if lazy:
+            return self._lazyCollections(triple_processor.getAllCollections())
+
+        tree = triple_processor.getCollectionTree()
+        metadata = self._metadataOf(relational_processor, tree)
+
+        return collections_from_tree(tree, metadata)
+
+
+    def _containersFrame(self, containers_data, entity_type):
+        # it returns a data frame with the columns id, type, label, title and
+        # creator of the collections or manifests described by a data frame
+        # with the columns id and label, with one query for their metadata
+        _, relational_processor = self._findProcessors()
+        frame = containers_data.reindex(columns=["id", "label"]).drop_duplicates(subset=["id"])
+        frame.insert(1, "type", entity_type)
+        if relational_processor is not None and not frame.empty:
+            metadata_data = relational_processor.getMetadataByIds(frame["id"].tolist())
+            metadata_data = metadata_data.reindex(columns=["id", "title", "creator"])
+            frame = frame.merge(metadata_data.drop_duplicates(subset=["id"]), on="id", how="left")
+        return frame.reindex(columns=ENTITY_COLUMNS).reset_index(drop=True)
+
+
+    def _lazyCollections(self, collections_data):
+        # it returns the collections described by a data frame with the columns
+        # id and label, whose manifests are fetched the first time they are needed
+        _, relational_processor = self._findProcessors()
+        metadata = self._metadataOf(relational_processor, collections_data)
+        return [Collection(id=collection_id, label=label,
+                           title=metadata.get(collection_id, (None, []))[0],
+                           creator=metadata.get(collection_id, (None, []))[1],
+                           loader=self._itemsLoader("getManifestsInCollection", collection_id,
+                                                    "Manifest", self._lazyManifests))
+                for collection_id, label in zip(_column(collections_data, "id"),
+                                                _column(collections_data, "label"))]
+
+
+    def _lazyManifests(self, manifests_data, metadata=None):
+        # it returns the manifests described by a data frame with the columns
+        # id and label, whose canvases are fetched the first time they are needed
+        if metadata is None:
+            _, relational_processor = self._findProcessors()
+            metadata = self._metadataOf(relational_processor, manifests_data)
+        return [Manifest(id=manifest_id, label=label,
+                         title=metadata.get(manifest_id, (None, []))[0],
+                         creator=metadata.get(manifest_id, (None, []))[1],
+                         loader=self._itemsLoader("getCanvasesInManifest", manifest_id,
+                                                  "Canvas", canvases_from_frame))
+                for manifest_id, label in zip(_column(manifests_data, "id"),
+                                              _column(manifests_data, "label"))]
+
+
+    def _entities(self, df):
+        # entities_from_frame, with the items of the manifests and collections
+        # fetched the first time they are needed
+        return entities_from_frame(df, loaders=self._containerLoader)
+
+
+    def _containerLoader(self, entity_type, entity_id):
+        # it returns the loader of the items of a manifest or a collection
+        if entity_type == "Manifest":
+            return self._itemsLoader("getCanvasesInManifest", entity_id,
+                                     "Canvas", canvases_from_frame)
+        return self._itemsLoader("getManifestsInCollection", entity_id,
+                                 "Manifest", self._lazyManifests)
+
+
+    def _itemsLoader(self, method_name, parent_id, item_type, converter):
+        # it returns a function which reads the items of a collection or a manifest,
+        # together with their metadata, and builds them with `converter`, in the
+        # order of the document from the containment closure in the relational
+        # database, with one query, if the parent is there
+        # otherwise they come from the triplestore, which stores no position:
+        # in the order of the store if they fit in a page of `items_page_size`,
+        # else in pages ordered by id; neither is guaranteed to be the document order
+        triple_processor, relational_processor = self._findProcessors()
+        page_size = self.items_page_size
+
+        def load_items():
+            if relational_processor is not None and relational_processor.hasContainment(parent_id):
+                items_data = relational_processor.getDescendants(parent_id, item_type, 1)
+                return converter(items_data, self._metadataOf(relational_processor, items_data))
+
+            if triple_processor is None:
+                return []
+            method = getattr(triple_processor, method_name)
+            items_data = method(parent_id, page_size + 1, 0, ordered=False)
+            if len(items_data) <= page_size:
+                return converter(items_data, self._metadataOf(relational_processor, items_data))
+            items = []
+            offset = 0
+            while True:
+                items_data = method(parent_id, page_size, offset)
+                metadata = self._metadataOf(relational_processor, items_data)
+                items.extend(converter(items_data, metadata))
+                if len(items_data) < page_size:
+                    return items
+                offset += page_size
+
+        return load_items
+
+
+    # the iter methods read all the entities of a kind a page at a time, and
+    # yield lists of at most `chunk_size` objects, so that the whole corpus can
+    # be scanned without holding it in memory; they are not cached
+
+    def _iterate(self, converter, method_name, chunk_size):
+        # it yields the objects built by `converter` from the data frames
+        # yielded by a method of the query processors, one processor after the other
         for processor in self.query_processors:
-            if hasattr(processor, "getAnnotationsWithTarget"):
-                annotations_data = processor.getAnnotationsWithTarget(canvas_id)
-                if not annotations_data.empty:
-                    images.extend([Image(id=annotation["body"]) for _, annotation in annotations_data.iterrows()])
+            if hasattr(processor, method_name):
+                for data in getattr(processor, method_name)(chunk_size):
+                    objects = converter(data)
+                    if objects:
+                        yield objects
 
-        return images
 
+    def iterAllAnnotations(self, chunk_size=1000):
+        # it yields lists of objects of the class Annotation
+        yield from self._iterate(annotations_from_frame, "iterAllAnnotations", chunk_size)
 
-    def getManifestsInCollection(self, collection_id):
-        # it returns a list of objects of the class Manifest
-        # which are contained in the collection with the same id as in the input 
-        manifests = []
-        
-        triple_processor = None
-        relational_processor = None
 
-        # find the triple and relational processors
-        for processor in self.query_processors:
-            if isinstance(processor, TriplestoreQueryProcessor):
-                triple_processor = processor
-            elif isinstance(processor, RelationalQueryProcessor):
-                relational_processor = processor
-    
-        if triple_processor is None or relational_processor is None:
-            return []  # return an empty list if either processor is not found   
-
-        triple_manifest = triple_processor.getManifestsInCollection(collection_id)
-
-        for _, manifest in triple_manifest.iterrows():
-            manifest_id = manifest["id"]
-            label = manifest.get("label")
-            items = self.getCanvasesInManifest(manifest["id"]),
-            title = None
-            creator = None
-
-            entity_data = relational_processor.getEntityById(manifest_id)
-            if not entity_data.empty:
-                title = entity_data.loc[0, "title"]
-                creator = entity_data.loc[0, "creator"]
-
-            manifests.append(Manifest(
-                id=manifest_id,
-                label=label,
-                title=title,
-                creator=creator,
-                items=items,
-            ))
-
-        return manifests      
-    
+    def iterAllImages(self, chunk_size=1000):
+        # it yields lists of objects of the class Image
+        yield from self._iterate(images_from_frame, "iterAllImages", chunk_size)
+
+
+    def iterAllCanvases(self, chunk_size=1000):
+        # it yields lists of objects of the class Canvas
+        yield from self._iterate(canvases_from_frame, "iterAllCanvases", chunk_size)
 
-    def getAllCollections(self):
-        # it returns a list of objects of the class Collection
-        collections = []
 
+    def iterAllManifests(self, chunk_size=1000):
+        # it yields lists of objects of the class Manifest, whose canvases
+        # are fetched the first time getItems() is called
+        yield from self._iterate(self._lazyManifests, "iterAllManifests", chunk_size)
+
+
+    def iterAllCollections(self, chunk_size=1000):
+        # it yields lists of objects of the class Collection, whose manifests
+        # are fetched the first time getItems() is called
+        yield from self._iterate(self._lazyCollections, "iterAllCollections", chunk_size)
+
+
+    def _findProcessors(self):
+        # it returns the triplestore and the relational query processors
+        # (or None when missing)
         triple_processor = None
         relational_processor = None
-
-        # find the triple and relational processors
         for processor in self.query_processors:
             if isinstance(processor, TriplestoreQueryProcessor):
                 triple_processor = processor
             elif isinstance(processor, RelationalQueryProcessor):
                 relational_processor = processor
-    
-        if triple_processor is None or relational_processor is None:
-            return []  # return an empty list if either processor is not found
-    
-        triple_collections = triple_processor.getAllCollections()
-
-        for _, collection in triple_collections.iterrows():
-            collection_id = collection["id"]
-            label = collection.get("label")
-            title = None
-            creator = None
-
-            entity_data = relational_processor.getEntityById(collection_id)
-            if not entity_data.empty:
-                title = entity_data.loc[0, "title"]
-                creator = entity_data.loc[0, "creator"]
-
-            items = self.getManifestsInCollection(collection_id)
-
-            collections.append(Collection(
-                id=collection_id,
-                label=label,
-                title=title,
-                creator=creator,
-                items=items,
-            ))
-
-        return collections
\ No newline at end of file
+        return triple_processor, relational_processor
+
+
+    def _metadataOf(self, relational_processor, tree):
+        # it returns a dictionary from the ids of the collections, manifests and
+        # canvases of a tree (or of a data frame with an id column)
+        # to their (title, creators), read with one query
+        if relational_processor is None or tree.empty:
+            return {}
+        ids = []
+        for column in ("id", "collection", "manifest", "canvas"):
+            if column in tree.columns:
+                ids.extend(tree[column].dropna().unique().tolist())
+        metadata_data = relational_processor.getMetadataByIds(ids)
+        return {row["id"]: (row.get("title"), split_creators(row.get("creator")))
+                for row in metadata_data.to_dict("records")}
@@ -1,6 +1,22 @@
+from sys import intern
+from weakref import WeakValueDictionary
+
+# the instances created through `shared`, by class and identifier
+_shared_instances = WeakValueDictionary()
+
+
+def _intern(value):
+    # only for the values repeated in many objects (e.g. the motivation of the
+    # annotations), interning keeps a single copy of the string; the ids repeated
+    # as bodies and targets are shared through `shared` instead
+    return intern(value) if type(value) is str else value
+
+
 class IdentifiableEntity(object):
     """A base class that provides an identifier for an entity."""
 
+    __slots__ = ("id", "__weakref__")
+
     def __init__(self, id: str) -> None:
         """
         Initialize an instance of the class with an identifier.
@@ -10,6 +26,25 @@ class IdentifiableEntity(object):
         """
         self.id = id
 
+    @classmethod
+    def shared(cls, id: str) -> "IdentifiableEntity":
+        """
+        Get an instance of the class with an identifier, reusing the one
+        already in memory for the same identifier, if any.
+        Only meant for the classes without other attributes (IdentifiableEntity, Image).
+        
+        :param id: A unique identifier for the entity.
+        :type id: str
+        :return: The instance with that identifier.
+        :rtype: IdentifiableEntity
+        """
+        key = (cls, id)
+        instance = _shared_instances.get(key)
+        if instance is None:
+            instance = cls(id)
+            _shared_instances[key] = instance
+        return instance
+
     def getId(self) -> str:
         """
         Get the identifier for the entity.
@@ -22,6 +57,9 @@ class IdentifiableEntity(object):
 
 class Image(IdentifiableEntity):
     """A subclass of the IdentifiableEntity class that represents an image entity with a unique identifier."""
+
+    __slots__ = ()
+
     def __init__(self, id: str):
         super().__init__(id)
 
@@ -32,6 +70,8 @@ class Annotation(IdentifiableEntity):
     a motivation, a target, and a body.
     """
 
+    __slots__ = ("body", "target", "motivation")
+
     def __init__(self, id: str, motivation: str, target: IdentifiableEntity, body: Image):
         """
         Initialize an instance of the class with an identifier, a motivation, a target, and a body.
@@ -48,7 +88,7 @@ class Annotation(IdentifiableEntity):
         super().__init__(id)
         self.body = body
         self.target = target
-        self.motivation = motivation
+        self.motivation = _intern(motivation)
 
 
     def getBody(self) -> Image:
@@ -80,6 +120,8 @@ class Annotation(IdentifiableEntity):
 
 
 class EntityWithMetadata(IdentifiableEntity):
+    __slots__ = ("label", "title", "creator")
+
     def __init__(self, id, label, title=None, creator=None) -> None:
         if creator is None:
             creator = []
@@ -92,37 +134,51 @@ class EntityWithMetadata(IdentifiableEntity):
         return self.label
 
     def getTitle(self) -> str:
-        if len (self.title) > 0:
+        if self.title:
             return self.title
         else:
             return None
 
-    def getCreator(self) -> str:
+    def getCreator(self) -> list:
         return self.creator
 
 
 class Collection(EntityWithMetadata):
-    def __init__(self, id, label, items=list, title=None, creator=None):
+    __slots__ = ("_items", "_loader")
+
+    def __init__(self, id, label, items=None, title=None, creator=None, loader=None):
+        # `loader` is a function returning the items, called the first time
+        # they are needed when `items` is not given
         super().__init__(id, label, title, creator)
-        self.items = list()
-        for item in items:
-            self.items.append(item)
+        self._items = list(items) if items is not None else None
+        self._loader = loader
 
     def getItems(self):
-        return self.items
+        if self._items is None:
+            self._items = list(self._loader()) if self._loader is not None else []
+            self._loader = None
+        return self._items
 
 
 class Manifest(EntityWithMetadata):
-    def __init__(self, id, label, items=list, title=None, creator=None):
+    __slots__ = ("_items", "_loader")
+
+    def __init__(self, id, label, items=None, title=None, creator=None, loader=None):
+        # `loader` is a function returning the items, called the first time
+        # they are needed when `items` is not given
         super().__init__(id, label, title, creator)
-        self.items = list()
-        for item in items:
-            self.items.append(item)
+        self._items = list(items) if items is not None else None
+        self._loader = loader
 
     def getItems(self):
-        return self.items
+        if self._items is None:
+            self._items = list(self._loader()) if self._loader is not None else []
+            self._loader = None
+        return self._items
 
 
 class Canvas(EntityWithMetadata):
+    __slots__ = ()
+
     def __init__(self, id, label, title=None, creator=None):
         super().__init__(id, label, title, creator)
@@ -0,0 +1,43 @@
+from argparse import ArgumentParser
+from os import makedirs
+from time import perf_counter
+from main import RelationalQueryProcessor, TriplestoreQueryProcessor
+
+# it writes the snapshot of the databases in a folder, to be opened by the
+# query processors with openSnapshot() instead of uploading the data again
+# e.g.
+#   python snapshot.py snapshots/2023-06 --db relational.db --graph http://127.0.0.1:9999/blazegraph/sparql
+# and then
+#   rel = RelationalQueryProcessor()
+#   rel.openSnapshot("snapshots/2023-06")
+#   trip = TriplestoreQueryProcessor()
+#   trip.openSnapshot("snapshots/2023-06")
+
+
+def export(folder, db_path=None, graph=None, format="arrow"):
+    # it returns True if all the requested parts of the snapshot were written
+    makedirs(folder, exist_ok=True)
+    done = True
+    for processor, path_url, args in ((RelationalQueryProcessor(), db_path, ()),
+                                      (TriplestoreQueryProcessor(), graph, (format,))):
+        if path_url is None:
+            continue
+        start = perf_counter()
+        processor.setDbPathOrUrl(path_url)
+        exported = processor.exportSnapshot(folder, *args)
+        processor.close()
+        print(f"{path_url}: {'done' if exported else 'failed'} in {perf_counter() - start:.2f}s")
+        done = done and exported
+    return done
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Write the snapshot of the databases in a folder")
+    parser.add_argument("folder")
+    parser.add_argument("--db", help="path of the relational database")
+    parser.add_argument("--graph", help="URL of the SPARQL endpoint or path of the N-Triples file")
+    parser.add_argument("--format", choices=["arrow", "parquet"], default="arrow",
+                        help="format of the collection graph file")
+    arguments = parser.parse_args()
+    if not export(arguments.folder, arguments.db, arguments.graph, arguments.format):
+        raise SystemExit(1)
@@ -12,12 +12,19 @@
 # DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
 # ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS
 # SOFTWARE.
+import asyncio
 import unittest
+from importlib.util import find_spec
 from os import sep
+from tempfile import TemporaryDirectory
+from time import sleep, perf_counter
 from main import AnnotationProcessor, MetadataProcessor, RelationalQueryProcessor
 from main import CollectionProcessor, TriplestoreQueryProcessor
 from main import GenericQueryProcessor
+from async_main import AsyncRelationalQueryProcessor, AsyncTriplestoreQueryProcessor, AsyncGenericQueryProcessor
 from pandas import DataFrame
+from rdflib import Literal, URIRef, RDF, RDFS
+from utils import upload_triples, LocalGraph, sparql_values
 from models.main_models import IdentifiableEntity, EntityWithMetadata, Canvas, Collection, Image, Annotation, Manifest
 
 # REMEMBER: before launching the tests, please run the Blazegraph instance!
@@ -51,7 +58,9 @@ class TestProjectBasic(unittest.TestCase):
         col_dp = CollectionProcessor()
         self.assertTrue(col_dp.setDbPathOrUrl(self.graph))
         self.assertEqual(col_dp.getDbPathOrUrl(), self.graph)
+        self.assertTrue(col_dp.setRelationalDbPath(self.relational))
         self.assertTrue(col_dp.uploadData(self.collection))
+        self.assertGreater(col_dp.getUploadStats()["triples"], 0)
 
     def test_04_RelationalQueryProcessor(self):
         rel_qp = RelationalQueryProcessor()
@@ -65,6 +74,20 @@ class TestProjectBasic(unittest.TestCase):
         self.assertIsInstance(rel_qp.getEntityById("just_a_test"), DataFrame)
         self.assertIsInstance(rel_qp.getEntitiesWithCreator("just_a_test"), DataFrame)
         self.assertIsInstance(rel_qp.getEntitiesWithTitle("just_a_test"), DataFrame)
+        self.assertIsInstance(rel_qp.getEntitiesByIds(["just_a_test", "another_test"]), DataFrame)
+        self.assertIsInstance(rel_qp.getAnnotationsWithTargets(["just_a_test"]), DataFrame)
+        self.assertIsInstance(rel_qp.getAnnotationsWithBodies(["just_a_test"]), DataFrame)
+        self.assertIsInstance(rel_qp.searchTitles("just_a_test"), DataFrame)
+        # the statements run by the full-text search are not round trips
+        rel_qp.resetStats()
+        rel_qp.searchTitles("Canzon")
+        self.assertLessEqual(rel_qp.getStats()["round_trips"], 2)
+        self.assertIsInstance(rel_qp.searchLabels("just_a_test"), DataFrame)
+        self.assertTrue(rel_qp.hasContainment())
+        self.assertIsInstance(rel_qp.getDescendants("just_a_test"), DataFrame)
+        can_1 = rel_qp.getDescendants("https://dl.ficlit.unibo.it/iiif/28429/collection", "Canvas")
+        self.assertGreater(len(can_1), 0)
+        self.assertIsInstance(rel_qp.getAnnotationsToDescendants("just_a_test"), DataFrame)
 
     def test_05_TriplestoreQueryProcessor(self):
         grp_qp = TriplestoreQueryProcessor()
@@ -95,6 +118,16 @@ class TestProjectBasic(unittest.TestCase):
         self.assertIsInstance(ann_1, list)
         for a in ann_1:
             self.assertIsInstance(a, Annotation)
+        ann_frame = generic.getAllAnnotations(return_type="frame")
+        self.assertIsInstance(ann_frame, DataFrame)
+        self.assertEqual(len(ann_frame), len(ann_1))
+        chunks = list(generic.iterAllAnnotations(chunk_size=100))
+        self.assertTrue(all(0 < len(chunk) <= 100 for chunk in chunks))
+        self.assertEqual(sorted(a.getId() for chunk in chunks for a in chunk),
+                         sorted(a.getId() for a in ann_1))
+        for chunk in generic.iterAllCanvases(chunk_size=100):
+            for a in chunk:
+                self.assertIsInstance(a, Canvas)
 
         self.assertIsInstance(generic.getAllCanvas(), list)
         can_1 = generic.getAllCanvas()
@@ -107,6 +140,21 @@ class TestProjectBasic(unittest.TestCase):
         self.assertIsInstance(col_1, list)
         for a in col_1:
             self.assertIsInstance(a, Collection)
+        col_2 = generic.getAllCollections(lazy=False)
+        col_2 = {a.getId(): a for a in col_2}
+        self.assertEqual(sorted(a.getId() for a in col_1), sorted(col_2))
+        for a in col_1:
+            self.assertEqual(sorted(m.getId() for m in a.getItems()),
+                             sorted(m.getId() for m in col_2[a.getId()].getItems()))
+        # the same items, lazy or not; the lazy ones in the order of the
+        # document when the manifest is in the containment closure
+        man_lazy = {m.getId(): m for m in generic.getAllManifests()}
+        for m in generic.getAllManifests(lazy=False):
+            lazy_items = [c.getId() for c in man_lazy[m.getId()].getItems()]
+            self.assertEqual(sorted(lazy_items), sorted(c.getId() for c in m.getItems()))
+            if rel_qp.hasContainment(m.getId()):
+                self.assertEqual(lazy_items,
+                                 list(rel_qp.getDescendants(m.getId(), "Canvas", 1)["id"]))
 
         self.assertIsInstance(generic.getAllImages(), list)
         ima_1 = generic.getAllImages()
@@ -137,6 +185,8 @@ class TestProjectBasic(unittest.TestCase):
         self.assertIsInstance(ann_4, list)
         for a in ann_4:
             self.assertIsInstance(a, Annotation)
+        self.assertGreater(len(ann_3), 0)
+        self.assertTrue({a.getId() for a in ann_3} <= {a.getId() for a in ann_4})
 
         self.assertIsInstance(generic.getAnnotationsWithBody("just_a_test"), list)
         ann_5 = generic.getAnnotationsWithBody("https://dl.ficlit.unibo.it/iiif/2/45499/full/699,800/0/default.jpg")
@@ -170,6 +220,9 @@ class TestProjectBasic(unittest.TestCase):
 
         # It must return None in case the entity does not exist
         self.assertEqual(generic.getEntityById("just_a_test"), None)
+        man_3 = generic.getEntityById("https://dl.ficlit.unibo.it/iiif/2/28429/manifest")
+        self.assertIsInstance(man_3, Manifest)
+        self.assertGreater(len(man_3.getItems()), 0)
         
         self.assertIsInstance(generic.getEntitiesWithCreator("just_a_test"), list)
         ent_1 = generic.getEntitiesWithCreator("Alighieri, Dante")
@@ -189,6 +242,30 @@ class TestProjectBasic(unittest.TestCase):
         for a in ent_3:
             self.assertIsInstance(a, EntityWithMetadata)
 
+        ent_6 = generic.getEntitiesByIds(["just_a_test", "https://dl.ficlit.unibo.it/iiif/2/28429/manifest"])
+        self.assertIsInstance(ent_6, dict)
+        self.assertEqual(ent_6["just_a_test"], None)
+        self.assertIsInstance(ent_6["https://dl.ficlit.unibo.it/iiif/2/28429/manifest"], Manifest)
+
+        ann_8 = generic.getAnnotationsWithTargets(["just_a_test", "https://dl.ficlit.unibo.it/iiif/2/28429/canvas/p3"])
+        self.assertIsInstance(ann_8, dict)
+        self.assertEqual(ann_8["just_a_test"], [])
+        for a in ann_8["https://dl.ficlit.unibo.it/iiif/2/28429/canvas/p3"]:
+            self.assertIsInstance(a, Annotation)
+
+        self.assertIsInstance(generic.searchTitles("just_a_test"), list)
+        ent_4 = generic.searchTitles("Canzon")
+        self.assertIsInstance(ent_4, list)
+        for a in ent_4:
+            self.assertIsInstance(a, EntityWithMetadata)
+
+        self.assertIsInstance(generic.searchLabels("just_a_test"), list)
+        ent_5 = generic.searchLabels("Dante", limit=5)
+        self.assertIsInstance(ent_5, list)
+        self.assertLessEqual(len(ent_5), 5)
+        for a in ent_5:
+            self.assertIsInstance(a, EntityWithMetadata)
+
         self.assertIsInstance(generic.getImagesAnnotatingCanvas("just_a_test"), list)
         ima_2 = generic.getImagesAnnotatingCanvas("https://dl.ficlit.unibo.it/iiif/2/28429/canvas/p7")
         self.assertIsInstance(ima_2, list)
@@ -200,3 +277,280 @@ class TestProjectBasic(unittest.TestCase):
         self.assertIsInstance(man_2, list)
         for a in man_2:
             self.assertIsInstance(a, Manifest)
+
+        self.assertTrue(generic.clearCache())
+        hits = generic.getCacheStats()["hits"]
+        generic.getCanvasesInManifest("https://dl.ficlit.unibo.it/iiif/2/28429/manifest")
+        generic.getCanvasesInManifest("https://dl.ficlit.unibo.it/iiif/2/28429/manifest")
+        self.assertEqual(generic.getCacheStats()["hits"], hits + 1)
+
+        records = []
+        self.assertTrue(generic.setCallback(records.append))
+        self.assertTrue(generic.clearCache())
+        generic.getAnnotationsToCanvas("https://dl.ficlit.unibo.it/iiif/2/28429/canvas/p1")
+        self.assertEqual(records[-1]["method"], "getAnnotationsToCanvas")
+        self.assertGreater(records[-1]["round_trips"], 0)
+        self.assertGreater(rel_qp.getStats()["round_trips"], 0)
+        self.assertIn("getAnnotationsToCanvas", generic.getStats()["methods"])
+
+    def test_07_AsyncGenericQueryProcessor(self):
+        rel_qp = AsyncRelationalQueryProcessor()
+        self.assertTrue(rel_qp.setDbPathOrUrl(self.relational))
+        grp_qp = AsyncTriplestoreQueryProcessor()
+        self.assertTrue(grp_qp.setDbPathOrUrl(self.graph))
+
+        generic = AsyncGenericQueryProcessor()
+        self.assertTrue(generic.addQueryProcessor([rel_qp, grp_qp]))
+
+        async def lookups():
+            return await asyncio.gather(
+                generic.getAnnotationsToCanvas("https://dl.ficlit.unibo.it/iiif/2/28429/canvas/p1"),
+                generic.getAllManifests(),
+                generic.getEntityById("just_a_test"))
+
+        ann_1, man_1, ent_1 = asyncio.run(lookups())
+        for a in ann_1:
+            self.assertIsInstance(a, Annotation)
+        for a in man_1:
+            self.assertIsInstance(a, Manifest)
+        self.assertEqual(ent_1, None)
+        self.assertIsInstance(asyncio.run(rel_qp.getAllAnnotations()), DataFrame)
+
+        # the items come already loaded: getItems() sends no query
+        man_2 = asyncio.run(generic.getEntityById("https://dl.ficlit.unibo.it/iiif/2/28429/manifest"))
+        round_trips = grp_qp.getStats()["round_trips"] + rel_qp.getStats()["round_trips"]
+        self.assertGreater(len(man_2.getItems()), 0)
+        self.assertEqual(grp_qp.getStats()["round_trips"] + rel_qp.getStats()["round_trips"],
+                         round_trips)
+
+    def test_08_LocalTriplestore(self):
+        with TemporaryDirectory() as folder:
+            local_graph = folder + sep + "graph.nt"
+            col_dp = CollectionProcessor()
+            self.assertTrue(col_dp.setDbPathOrUrl(local_graph))
+            self.assertTrue(col_dp.uploadData(self.collection))
+
+            grp_qp = TriplestoreQueryProcessor()
+            self.assertTrue(grp_qp.setDbPathOrUrl(local_graph))
+            self.assertIsInstance(grp_qp.getAllCanvases(), DataFrame)
+            self.assertGreater(len(grp_qp.getAllCanvases()), 0)
+            man_1 = grp_qp.getCanvasesInManifest("https://dl.ficlit.unibo.it/iiif/2/28429/manifest")
+            self.assertGreater(len(man_1), 0)
+
+            # the labels with line breaks are written as valid N-Triples
+            multiline_graph = folder + sep + "multiline.nt"
+            label = Literal('first line\nsecond "line"')
+            upload_triples(multiline_graph, [(URIRef("https://example.org/c"), RDFS.label, label)])
+            self.assertIn(label, LocalGraph(multiline_graph).graph.objects())
+
+    @unittest.skipUnless(find_spec("pyarrow"), "the snapshots require pyarrow")
+    def test_09_Snapshot(self):
+        with TemporaryDirectory() as folder:
+            local_graph = folder + sep + "graph.nt"
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(local_graph)
+            col_dp.uploadData(self.collection)
+
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(self.relational)
+            self.assertTrue(rel_qp.exportSnapshot(folder))
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(local_graph)
+            self.assertTrue(grp_qp.exportSnapshot(folder, "parquet"))
+
+            snap_rel = RelationalQueryProcessor()
+            self.assertTrue(snap_rel.openSnapshot(folder))
+            self.assertEqual(len(snap_rel.getAllAnnotations()), len(rel_qp.getAllAnnotations()))
+            snap_grp = TriplestoreQueryProcessor()
+            self.assertTrue(snap_grp.openSnapshot(folder))
+            self.assertEqual(len(snap_grp.getAllCanvases()), len(grp_qp.getAllCanvases()))
+            self.assertFalse(snap_grp.openSnapshot(folder + sep + "missing"))
+            snap_rel.close()
+
+    def test_10_PartialContainment(self):
+        # collection-2 is uploaded without the relational database, so its
+        # containment is not stored there and the triplestore is used instead
+        with TemporaryDirectory() as folder:
+            relational = folder + sep + "relational.db"
+            local_graph = folder + sep + "graph.nt"
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(relational)
+            ann_dp.uploadData(self.annotations)
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(local_graph)
+            col_dp.setRelationalDbPath(relational)
+            col_dp.uploadData(self.collection)
+            col_dp = CollectionProcessor()
+            col_dp.setDbPathOrUrl(local_graph)
+            col_dp.uploadData("data" + sep + "collection-2.json")
+
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+            grp_qp = TriplestoreQueryProcessor()
+            grp_qp.setDbPathOrUrl(local_graph)
+            generic = GenericQueryProcessor()
+            generic.addQueryProcessor([rel_qp, grp_qp])
+
+            collection_id = "https://dl.ficlit.unibo.it/iiif/19428-19425/collection"
+            self.assertFalse(rel_qp.hasContainment(collection_id))
+            canvases = list(grp_qp.getCanvasesInCollection(collection_id)["id"])
+            expected = rel_qp.getAnnotationsWithTargets(canvases)
+            self.assertGreater(len(expected), 0)
+            annotations = generic.getAnnotationsToCollection(collection_id)
+            self.assertEqual({a.getId() for a in annotations}, set(expected["id"]))
+            manifest_id = "https://dl.ficlit.unibo.it/iiif/2/19428/manifest"
+            eager = [m for m in generic.getAllManifests(lazy=False) if m.getId() == manifest_id]
+            lazy = [m for m in generic.getAllManifests() if m.getId() == manifest_id]
+            self.assertEqual(sorted(c.getId() for c in lazy[0].getItems()),
+                             sorted(c.getId() for c in eager[0].getItems()))
+            rel_qp.close()
+
+    def test_11_Timeout(self):
+        # a processor that does not answer in time is skipped, without
+        # holding up the next calls
+        class SlowProcessor(RelationalQueryProcessor):
+            def getAllAnnotations(self):
+                sleep(1)
+                return super().getAllAnnotations()
+
+        rel_qp = RelationalQueryProcessor()
+        rel_qp.setDbPathOrUrl(self.relational)
+        slow_qp = SlowProcessor()
+        slow_qp.setDbPathOrUrl(self.relational)
+        generic = GenericQueryProcessor(max_workers=2)
+        generic.addQueryProcessor([rel_qp, slow_qp])
+        self.assertTrue(generic.setTimeout(0.2, slow_qp))
+        expected = len(rel_qp.getAllAnnotations())
+        for _ in range(2):
+            start = perf_counter()
+            annotations = generic.getAllAnnotations()
+            self.assertLess(perf_counter() - start, 0.9)
+            self.assertEqual(len(annotations), expected)
+        # the incomplete results are not cached
+        self.assertEqual(generic.getCacheStats()["hits"], 0)
+        generic.cleanQueryProcessors()
+
+    def _write_annotations(self, folder, name, rows):
+        path = folder + sep + name
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("id,body,target,motivation\n")
+            f.writelines(",".join(row) + "\n" for row in rows)
+        return path
+
+    def test_12_UploadModes(self):
+        with TemporaryDirectory() as folder:
+            relational = folder + sep + "relational.db"
+            first = self._write_annotations(folder, "first.csv", [
+                ("a1", "b1", "t1", "painting"), ("a2", "b2", "t2", "painting")])
+            second = self._write_annotations(folder, "second.csv", [
+                ("a2", "b2-new", "t2", "painting"), ("a3", "b3", "t3", "painting")])
+            third = self._write_annotations(folder, "third.csv", [
+                ("a3", "b3-new", "t3", "painting"), ("a4", "b4", "t4", "painting")])
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(relational)
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+
+            def bodies():
+                data = rel_qp.getAllAnnotations()
+                return dict(zip(data["id"], data["body"]))
+
+            # upsert: the rows of the first file are kept, the overlapping one is updated
+            self.assertTrue(ann_dp.uploadData(first))
+            self.assertTrue(ann_dp.uploadData(second))
+            self.assertEqual(bodies(), {"a1": "b1", "a2": "b2-new", "a3": "b3"})
+            # append: the rows already stored are left as they are
+            self.assertTrue(ann_dp.uploadData(third, mode="append"))
+            self.assertEqual(bodies(), {"a1": "b1", "a2": "b2-new", "a3": "b3", "a4": "b4"})
+            # replace: only the rows of the file are left
+            self.assertTrue(ann_dp.uploadData(first, mode="replace"))
+            self.assertEqual(bodies(), {"a1": "b1", "a2": "b2"})
+            rel_qp.close()
+
+    def test_13_ChunkedUpload(self):
+        with TemporaryDirectory() as folder:
+            relational = folder + sep + "relational.db"
+            path = self._write_annotations(folder, "annotations.csv", [
+                ("a%d" % i, "b%d" % i, "t%d" % i, "painting") for i in range(5)])
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(relational)
+            self.assertFalse(ann_dp.uploadData(path, mode="unknown"))
+            self.assertIsNone(ann_dp.getUploadStats())
+            self.assertTrue(ann_dp.uploadData(path, chunk_size=2))
+            stats = ann_dp.getUploadStats()
+            self.assertEqual(stats["rows"], 5)
+            self.assertEqual(stats["chunks"], 3)
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+            self.assertEqual(len(rel_qp.getAllAnnotations()), 5)
+            rel_qp.close()
+
+    def test_14_UploadInvalidatesCache(self):
+        with TemporaryDirectory() as folder:
+            relational = folder + sep + "relational.db"
+            first = self._write_annotations(folder, "first.csv", [
+                ("a1", "b1", "t1", "painting")])
+            second = self._write_annotations(folder, "second.csv", [
+                ("a2", "b2", "t2", "painting")])
+            ann_dp = AnnotationProcessor()
+            ann_dp.setDbPathOrUrl(relational)
+            self.assertTrue(ann_dp.uploadData(first))
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+            generic = GenericQueryProcessor()
+            generic.addQueryProcessor(rel_qp)
+
+            self.assertEqual(len(generic.getAllAnnotations()), 1)
+            self.assertEqual(len(generic.getAllAnnotations()), 1)
+            misses = generic.getCacheStats()["misses"]
+            self.assertTrue(ann_dp.uploadData(second))
+            annotations = generic.getAllAnnotations()
+            self.assertEqual({a.getId() for a in annotations}, {"a1", "a2"})
+            self.assertEqual(generic.getCacheStats()["misses"], misses + 1)
+            generic.cleanQueryProcessors()
+
+    def test_15_EscapedTerms(self):
+        # labels with quotes and backslashes and non-ASCII IRIs survive the
+        # upload (nt_line) and the lookups binding them (sparql_values)
+        with TemporaryDirectory() as folder:
+            local_graph = folder + sep + "graph.nt"
+            entity_id = "https://example.org/città/canvas/1"
+            label = 'a "quoted" label with a \\ backslash'
+            entity = URIRef(entity_id)
+            upload_triples(local_graph, [
+                (entity, URIRef("https://schema.org/identifier"), Literal(entity_id)),
+                (entity, RDF.type, URIRef("https://github.com/eugeniavd/data_iif/Canvas")),
+                (entity, RDFS.label, Literal(label))])
+            self.assertIn(Literal(label), LocalGraph(local_graph).graph.objects())
+
+            grp_qp = TriplestoreQueryProcessor()
+            self.assertTrue(grp_qp.setDbPathOrUrl(local_graph))
+            self.assertEqual(list(grp_qp.getEntitiesWithLabel(label)["id"]), [entity_id])
+            found = grp_qp.getEntitiesByIds([entity_id, "just_a_test"])
+            self.assertEqual(list(found["label"]), [label])
+            self.assertIn('\\"quoted\\"', sparql_values("SELECT * WHERE { ?s ?p ?o }",
+                                                   {"o": Literal(label)}))
+
+    def test_16_MultipleCreators(self):
+        # each of the creators listed in a row finds the entity
+        with TemporaryDirectory() as folder:
+            relational = folder + sep + "relational.db"
+            path = folder + sep + "metadata.csv"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write('id,title,creator\n'
+                        'e1,First,"Doe, John; Doe, Jane"\n'
+                        'e2,Second,"Doe, Jane"\n')
+            met_dp = MetadataProcessor()
+            met_dp.setDbPathOrUrl(relational)
+            self.assertTrue(met_dp.uploadData(path))
+            rel_qp = RelationalQueryProcessor()
+            rel_qp.setDbPathOrUrl(relational)
+            generic = GenericQueryProcessor()
+            generic.addQueryProcessor(rel_qp)
+
+            self.assertEqual(sorted(rel_qp.getEntitiesWithCreator("Doe, Jane")["id"]), ["e1", "e2"])
+            ent_1 = generic.getEntitiesWithCreator("Doe, John")
+            self.assertEqual([e.getId() for e in ent_1], ["e1"])
+            self.assertEqual(ent_1[0].getCreator(), ["Doe, John", "Doe, Jane"])
+            self.assertEqual(len(generic.getEntitiesWithCreator("Doe, John; Doe, Jane")), 1)
+            generic.cleanQueryProcessors()
@@ -1,79 +1,892 @@
+import re
 from sqlite3 import connect
+from time import perf_counter, monotonic
+from threading import Lock, RLock
+from os import remove, replace
+from os.path import abspath, exists, join
+from collections import OrderedDict
+from hashlib import sha1
+from io import BytesIO
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from functools import lru_cache
 import pandas as pd
-from json import load
-from rdflib import Graph, Literal, RDF, RDFS, URIRef
+from json import JSONDecoder, JSONDecodeError
+from rdflib import BNode, Graph, Literal, RDF, RDFS, URIRef
+from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
 
 
-def upload_to_db(db_path, df, name):
+UPLOAD_MODES = ("upsert", "append", "replace")
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _create_table(con, name, columns):
+    # every table is keyed on `id`, so that rows can be upserted
+    column_defs = ", ".join(_quote(column) + (" TEXT PRIMARY KEY" if column == "id" else " TEXT")
+                            for column in columns)
+    con.execute(f"CREATE TABLE IF NOT EXISTS {_quote(name)} ({column_defs})")
+
+
+def _prepare_table(con, name, columns):
+    # it creates the table if needed, adds the missing columns and rebuilds
+    # the tables written by older versions, which had no primary key on `id`
+    table_info = con.execute(f"PRAGMA table_info({_quote(name)})").fetchall()
+    if not table_info:
+        _create_table(con, name, columns)
+        return
+
+    existing = [row[1] for row in table_info]
+    for column in columns:
+        if column not in existing:
+            con.execute(f"ALTER TABLE {_quote(name)} ADD COLUMN {_quote(column)} TEXT")
+            existing.append(column)
+
+    if not any(row[1] == "id" and row[5] for row in table_info):
+        old_name = name + "_old"
+        con.execute(f"ALTER TABLE {_quote(name)} RENAME TO {_quote(old_name)}")
+        _create_table(con, name, existing)
+        column_list = ", ".join(_quote(column) for column in existing)
+        con.execute(f"INSERT OR REPLACE INTO {_quote(name)} ({column_list}) "
+                    f"SELECT {column_list} FROM {_quote(old_name)}")
+        con.execute(f"DROP TABLE {_quote(old_name)}")
+
+
+# secondary indexes of the relational tables, the primary key on `id`
+# already covers the lookups by identifier
+# (body, target) also serves the lookups on body alone
+TABLE_INDEXES = {
+    "Annotations": (("target",), ("body", "target")),
+    "Metadata": (("title",), ("creator",)),
+}
+
+
+def _create_indexes(con, name, columns):
+    # it creates the secondary indexes of the table that are still missing
+    for index_columns in TABLE_INDEXES.get(name, ()):
+        if all(column in columns for column in index_columns):
+            index_name = "idx_" + name.lower() + "_" + "_".join(index_columns)
+            column_list = ", ".join(_quote(column) for column in index_columns)
+            con.execute(f"CREATE INDEX IF NOT EXISTS {_quote(index_name)} "
+                        f"ON {_quote(name)} ({column_list})")
+
+
+def split_creators(value):
+    # creators are stored as a single string, e.g. "Doe, John; Doe, Jane"
+    if not isinstance(value, str):
+        return []
+    return [creator.strip() for creator in value.split(";") if creator.strip()]
+
+
+def _create_search_index(con, fts_name, table, column):
+    # it creates a FTS5 index on a column of a table, kept in sync with the
+    # table by triggers (the text is not copied, the index refers to the
+    # rowid of the table)
+    exists = con.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts_name,)).fetchone()
+    fts, source, text = _quote(fts_name), _quote(table), _quote(column)
+    con.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                f"{text}, content={source}, content_rowid='rowid', "
+                f"tokenize='unicode61 remove_diacritics 2')")
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {_quote(fts_name + '_insert')} AFTER INSERT ON {source} BEGIN "
+                f"INSERT INTO {fts} (rowid, {text}) VALUES (new.rowid, new.{text}); END")
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {_quote(fts_name + '_delete')} AFTER DELETE ON {source} BEGIN "
+                f"INSERT INTO {fts} ({fts}, rowid, {text}) VALUES ('delete', old.rowid, old.{text}); END")
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {_quote(fts_name + '_update')} AFTER UPDATE ON {source} BEGIN "
+                f"INSERT INTO {fts} ({fts}, rowid, {text}) VALUES ('delete', old.rowid, old.{text}); "
+                f"INSERT INTO {fts} (rowid, {text}) VALUES (new.rowid, new.{text}); END")
+    if not exists:
+        # indexing the rows stored before the index existed
+        con.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+def to_fts_query(text, prefix=True):
+    # auxiliary function, it turns a text typed by a user into a FTS5 query
+    # matching all its words (or words starting with them, if `prefix`)
+    words = re.findall(r"\w+", text or "")
+    suffix = "*" if prefix else ""
+    return " ".join(f'"{word}"{suffix}' for word in words)
+
+
+def _prepare_metadata(con, columns):
+    # EntityCreators holds one row per entity and creator
+    con.execute("CREATE TABLE IF NOT EXISTS EntityCreators ("
+                "entity_id TEXT NOT NULL, position INTEGER NOT NULL, creator TEXT NOT NULL, "
+                "PRIMARY KEY (entity_id, position))")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_entitycreators_creator "
+                "ON EntityCreators (creator, entity_id)")
+    if "title" in columns:
+        _create_search_index(con, "TitleSearch", "Metadata", "title")
+
+
+def _sync_creators(con, chunk):
+    # it rebuilds the rows of EntityCreators for the metadata entities just loaded
+    if "creator" not in chunk.columns:
+        return
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS loaded_ids (id TEXT PRIMARY KEY)")
+    con.execute("DELETE FROM temp.loaded_ids")
+    con.executemany("INSERT OR IGNORE INTO temp.loaded_ids VALUES (?)",
+                    ((id,) for id in chunk["id"].tolist()))
+
+    con.execute("DELETE FROM EntityCreators WHERE entity_id IN (SELECT id FROM temp.loaded_ids)")
+    stored = con.execute("SELECT id, creator FROM Metadata "
+                         "WHERE id IN (SELECT id FROM temp.loaded_ids)").fetchall()
+    con.executemany("INSERT INTO EntityCreators (entity_id, position, creator) VALUES (?, ?, ?)",
+                    ((id, position, creator) for id, value in stored
+                     for position, creator in enumerate(split_creators(value))))
+
+
+# tables derived from a loaded table: they are dropped together with it,
+# created by the first hook and updated by the second one after each chunk
+DERIVED_TABLES = {
+    "Metadata": (("EntityCreators", "TitleSearch"), _prepare_metadata, _sync_creators),
+}
+
+
+def _insert_statement(name, columns, mode):
+    column_list = ", ".join(_quote(column) for column in columns)
+    placeholders = ", ".join("?" for _ in columns)
+    statement = f"INSERT INTO {_quote(name)} ({column_list}) VALUES ({placeholders})"
+    updates = ", ".join(f"{_quote(column)} = excluded.{_quote(column)}"
+                        for column in columns if column != "id")
+    if mode == "upsert" and updates:
+        return statement + f" ON CONFLICT(id) DO UPDATE SET {updates}"
+    return statement + " ON CONFLICT(id) DO NOTHING"
+
+
+# pragmas used while loading: WAL journal, no fsync at every commit and a
+# 64MB page cache, the data is safe once the transaction is committed
+BULK_LOAD_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+def upload_to_db(db_path, data, name, mode="upsert"):
     # auxiliary function for database updates. 
-    # it loads data from dataframes, in case of an error, returns a value of False
+    # it loads data from a dataframe, or from an iterable of dataframes
+    # (e.g. the chunks of a CSV file), in a single transaction
+    # rows are keyed on `id`:
+    # - "upsert" inserts the new rows and updates the ones already stored
+    # - "append" inserts the new rows and leaves the stored ones untouched
+    # - "replace" drops the table and writes it again
+    # it returns the load statistics, in case of an error it returns None
+    if mode not in UPLOAD_MODES:
+        print(f"Upload failed: unknown mode {mode!r}, use one of {UPLOAD_MODES}")
+        return None
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    start = perf_counter()
+    rows = 0
+    chunks = 0
+    statement = None
+    con = connect(db_path, isolation_level=None)
     try:
-        df.to_sql(name, connect(db_path), if_exists='replace', index=False)
-        return True
+        for pragma in BULK_LOAD_PRAGMAS:
+            con.execute(pragma)
+
+        con.execute("BEGIN")
+        try:
+            derived_tables, prepare, sync = DERIVED_TABLES.get(name, ((), None, None))
+            if mode == "replace":
+                for table in (name,) + derived_tables:
+                    con.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+            for chunk in data:
+                if statement is None:
+                    columns = list(chunk.columns)
+                    _prepare_table(con, name, columns)
+                    if prepare is not None:
+                        prepare(con, columns)
+                    statement = _insert_statement(name, columns, mode)
+                con.executemany(statement, chunk.itertuples(index=False, name=None))
+                if sync is not None:
+                    sync(con, chunk)
+                rows += len(chunk)
+                chunks += 1
+            # the indexes are built after the rows when the table is new
+            if statement is not None:
+                _create_indexes(con, name, columns)
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+        # refreshing the statistics used by the query planner
+        if statement is not None:
+            con.execute(f"ANALYZE {_quote(name)}")
+
+        seconds = perf_counter() - start
+        return {"rows": rows, "chunks": chunks, "seconds": seconds,
+                "rows_per_second": rows / seconds if seconds else 0.0}
     except Exception as e:
         print(f"Upload failed: {e}")
-        return False
+        return None
+    finally:
+        con.close()
+
+
+def is_remote(path_url):
+    # auxiliary function, it tells a SPARQL endpoint from the path of a local file
+    return str(path_url).lower().startswith(("http://", "https://"))
+
+
+class LocalGraph(object):
+    # auxiliary class, an in-process triplestore: the triples are kept in an
+    # rdflib graph (indexed in memory by subject, predicate and object) and
+    # persisted in an N-Triples file, to which every upload is appended
+    # the same SPARQL queries sent to the endpoints run on it in process
+    # the graph of a snapshot (see snapshot_frame) is built from the columns
+    # of its file instead, without parsing, and it is read-only; unlike the
+    # snapshot of the relational database it is still loaded in memory as a whole
+
+    def __init__(self, path):
+        self.path = path
+        self.graph = Graph()
+        self.lock = RLock()
+        self.read_only = is_snapshot(path)
+        if self.read_only:
+            self.graph.addN((s, p, o, self.graph)
+                            for s, p, o in snapshot_triples(read_columnar(path)))
+        elif exists(path):
+            self.graph.parse(path, format="nt")
+
+    def add(self, lines, triples):
+        # it stores triples, given together with their N-Triples lines
+        if self.read_only:
+            raise ValueError(f"The snapshot {self.path} is read-only")
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            self.graph.addN((s, p, o, self.graph) for s, p, o in triples)
+
+    def query(self, query, initBindings=None):
+        # it runs a SELECT query and returns its results as a data frame of strings
+        with self.lock:
+            result = self.graph.query(query, initBindings=initBindings or {})
+            columns = [str(var) for var in result.vars]
+            rows = [[str(value) if value is not None else None for value in row]
+                    for row in result]
+        return pd.DataFrame(rows, columns=columns)
+
+
+# the local graphs opened so far, by absolute path, shared by all processors
+_local_graphs = {}
+_local_graphs_lock = Lock()
+
+
+def local_graph(path):
+    # auxiliary function, it returns the local graph stored in a file,
+    # loading it the first time it is needed
+    path = abspath(path)
+    with _local_graphs_lock:
+        graph = _local_graphs.get(path)
+        if graph is None:
+            graph = _local_graphs[path] = LocalGraph(path)
+        return graph
+
+
+def forget_local_graph(path):
+    # auxiliary function, it drops a local graph from the ones loaded, e.g.
+    # because its snapshot has been written again
+    with _local_graphs_lock:
+        _local_graphs.pop(abspath(path), None)
+
+
+def _nt_string(value):
+    return '"' + (value.replace("\\", "\\\\").replace('"', '\\"')
+                  .replace("\n", "\\n").replace("\r", "\\r")) + '"'
+
+
+def nt_line(triple):
+    # auxiliary function, it writes a triple as a line of N-Triples, which is
+    # also valid in an INSERT DATA request
+    # n3() writes the literals with line breaks between triple quotes,
+    # that N-Triples does not allow, so their characters are escaped here
+    terms = []
+    for term in triple:
+        if isinstance(term, Literal):
+            text = _nt_string(str(term))
+            if term.language:
+                text += "@" + term.language
+            elif term.datatype:
+                text += "^^" + URIRef(term.datatype).n3()
+            terms.append(text)
+        else:
+            terms.append(term.n3())
+    return " ".join(terms) + " ."
+
+
+def upload_triples(endpoint, triples, batch_size=5000):
+    # auxiliary function, it sends triples to a SPARQL endpoint in batches:
+    # every batch is serialised as N-Triples inside a single INSERT DATA
+    # request, so the endpoint applies it in one transaction
+    # if `endpoint` is the path of a file, the triples are added to the local graph
+    # it returns the number of triples and batches sent
+    start = perf_counter()
+    sent = 0
+    batches = 0
+    batch = []
+
+    if not is_remote(endpoint):
+        graph = local_graph(endpoint)
+        batch_triples = []
+        for triple in triples:
+            batch.append(nt_line(triple))
+            batch_triples.append(triple)
+            if len(batch) >= batch_size:
+                graph.add(batch, batch_triples)
+                sent += len(batch)
+                batches += 1
+                batch = []
+                batch_triples = []
+        if batch:
+            graph.add(batch, batch_triples)
+            sent += len(batch)
+            batches += 1
+        return {"triples": sent, "batches": batches, "seconds": perf_counter() - start}
+
+    store = SPARQLUpdateStore()
+    store.open((endpoint, endpoint))
+    try:
+        for triple in triples:
+            batch.append(nt_line(triple))
+            if len(batch) >= batch_size:
+                store.update("INSERT DATA {\n" + "\n".join(batch) + "\n}")
+                sent += len(batch)
+                batches += 1
+                batch = []
+        if batch:
+            store.update("INSERT DATA {\n" + "\n".join(batch) + "\n}")
+            sent += len(batch)
+            batches += 1
+    finally:
+        store.close()
+
+    return {"triples": sent, "batches": batches, "seconds": perf_counter() - start}
+
+
+def iri_or_none(value):
+    # auxiliary function, it returns the IRI in the input as an rdflib term,
+    # or None if it is not a valid IRI
+    try:
+        iri = URIRef(str(value))
+        iri.n3()
+        return iri
+    except Exception:
+        return None
+
+
+def sparql_select(endpoint, query, timeout=None):
+    # auxiliary function, it sends a SELECT query to a SPARQL endpoint (with
+    # POST) and returns its results, read as CSV, in a data frame
+    # the request is abandoned if the endpoint does not answer for `timeout`
+    # seconds (None for no limit)
+    request = Request(endpoint, data=urlencode({"query": query}).encode("utf-8"),
+                      headers={"Accept": "text/csv"})
+    with urlopen(request, timeout=timeout) as response:
+        return pd.read_csv(BytesIO(response.read()), sep=",")
+
 
+_WHERE = re.compile(r"WHERE\s*\{", re.IGNORECASE)
 
-def remove_invalid_char(string):
-    # auxiliary function, it removes invalid chars found in the imported data
-    if '\"' in string:
-        return string.replace('\"', '\\\"')
-    elif '"' in string:
-        return string.replace('"', '\\\"')
+
+def sparql_values(query, bindings):
+    # auxiliary function, it binds the variables of a query to rdflib terms
+    # (or lists of terms) with a VALUES block at the start of the WHERE clause
+    # the terms are written with n3(), which escapes them as SPARQL requires
+    if not bindings:
+        return query
+    values = " ".join(
+        "VALUES ?" + name + " { " + " ".join(term.n3() for term in
+                                           (terms if isinstance(terms, list) else [terms])) + " }"
+        for name, terms in bindings.items())
+    match = _WHERE.search(query)
+    return query[:match.end()] + "\n    " + values + query[match.end():]
+
+
+# the files of a snapshot, written in a folder by the exportSnapshot methods
+# of the query processors: a compacted copy of the relational database, ready
+# to be opened, and the collection graph as a columnar file, in the Arrow IPC
+# format (uncompressed, so that it can be memory-mapped) or in Parquet
+SNAPSHOT_FORMATS = {"arrow": ".arrow", "parquet": ".parquet"}
+SNAPSHOT_DB = "snapshot.db"
+SNAPSHOT_GRAPH = "Collections"
+# bytes of a snapshot database read through a memory map instead of read() calls
+SNAPSHOT_MMAP_SIZE = 1 << 30
+
+
+def _pyarrow():
+    # pyarrow is only needed by the columnar files, it is imported when they are used
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The columnar snapshot files require pyarrow")
+    return pyarrow
+
+
+def snapshot_file(folder, name, format="arrow"):
+    # auxiliary function, it returns the path of a columnar file of a snapshot
+    if format not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Unknown snapshot format {format!r}, use one of {tuple(SNAPSHOT_FORMATS)}")
+    return join(folder, name + SNAPSHOT_FORMATS[format])
+
+
+def find_snapshot_file(folder, name):
+    # auxiliary function, it returns the path of the columnar file of a snapshot
+    # in any of the formats, or None if there is none
+    for format in SNAPSHOT_FORMATS:
+        path = snapshot_file(folder, name, format)
+        if exists(path):
+            return path
+    return None
+
+
+def is_snapshot(path):
+    # auxiliary function, it tells the columnar file of a snapshot by its extension
+    return str(path).lower().endswith(tuple(SNAPSHOT_FORMATS.values()))
+
+
+def write_columnar(frame, path):
+    # auxiliary function, it writes a data frame in a columnar file,
+    # in the format given by its extension, and returns the number of rows
+    pa = _pyarrow()
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    if path.lower().endswith(SNAPSHOT_FORMATS["parquet"]):
+        pa.parquet.write_table(table, path)
+    else:
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    return table.num_rows
+
+
+def read_columnar(path):
+    # auxiliary function, it returns the pyarrow table stored in a columnar file
+    # the file is memory-mapped: an Arrow IPC file is not copied at all, its
+    # columns point to the pages of the file, read by the system when used
+    pa = _pyarrow()
+    if path.lower().endswith(SNAPSHOT_FORMATS["parquet"]):
+        return pa.parquet.read_table(path, memory_map=True)
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def export_database(db_path, folder):
+    # auxiliary function, it writes the snapshot of a relational database:
+    # a compacted copy made with VACUUM INTO, which keeps the indexes, the
+    # search tables and the containment closure
+    # the copy is written in a temporary file, which replaces the previous
+    # snapshot only once it is complete
+    if not exists(db_path):
+        raise FileNotFoundError(db_path)
+    target = join(folder, SNAPSHOT_DB)
+    if abspath(target) == abspath(db_path):
+        raise ValueError(f"The snapshot would overwrite the database {db_path}")
+    partial = target + ".partial"
+    if exists(partial):
+        remove(partial)
+    con = connect(db_path)
+    try:
+        con.execute("VACUUM INTO ?", (partial,))
+    except BaseException:
+        if exists(partial):
+            remove(partial)
+        raise
+    finally:
+        con.close()
+    replace(partial, target)
+    return target
+
+
+def _term_kind(term):
+    if isinstance(term, Literal):
+        return "literal"
+    return "bnode" if isinstance(term, BNode) else "iri"
+
+
+def snapshot_frame(triples):
+    # auxiliary function, it returns a data frame with one row per triple in
+    # the input: the values of the subject, predicate and object, the kind of
+    # the object ("iri", "bnode" or "literal") and its language and datatype
+    rows = [(str(s), str(p), str(o), _term_kind(o),
+             o.language if isinstance(o, Literal) else None,
+             str(o.datatype) if isinstance(o, Literal) and o.datatype else None)
+            for s, p, o in triples]
+    return pd.DataFrame(rows, columns=["subject", "predicate", "object", "kind",
+                                       "language", "datatype"])
+
+
+def snapshot_triples(table):
+    # auxiliary function, it returns the triples stored in a columnar file
+    # (see snapshot_frame), building the terms straight from its columns
+    # the subjects and predicates (always IRIs in the collection graph) repeat,
+    # so one term is made for each of them
+    iris = {}
+
+    def iri(value):
+        term = iris.get(value)
+        if term is None:
+            term = iris[value] = URIRef(value)
+        return term
+
+    columns = [table.column(name).to_pylist() for name in
+               ("subject", "predicate", "object", "kind", "language", "datatype")]
+    for s, p, o, kind, language, datatype in zip(*columns):
+        if kind == "literal":
+            o = Literal(o, lang=language, datatype=datatype)
+        elif kind == "bnode":
+            o = BNode(o)
+        else:
+            o = iri(o)
+        yield iri(s), iri(p), o
+
+
+IIIF_LEVELS = ("Collection", "Manifest", "Canvas")
+
+
+class JsonStream(object):
+    # auxiliary class, it reads a JSON document incrementally from a file,
+    # keeping in memory only the part of the text that is being parsed
+
+    def __init__(self, file, chunk_size=65536):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        # it drops the consumed text and appends at least `size` new characters
+        data = self.file.read(size)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        if not data:
+            self.eof = True
+        return bool(data)
+
+    def peek(self):
+        # it skips whitespaces and returns the next character ("" at the end)
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(self.chunk_size):
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        # it decodes the next complete JSON value, reading more text when
+        # the value is not entirely in the buffer yet
+        first = self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except JSONDecodeError:
+                if self.eof:
+                    raise
+                # the read size doubles with the pending text, so that
+                # long values are not parsed again and again
+                self._fill(max(self.chunk_size, len(self.buffer) - self.pos))
+                continue
+            # a number at the end of the buffer could be truncated
+            if end == len(self.buffer) and not self.eof and first not in '{["':
+                self._fill(self.chunk_size)
+                continue
+            self.pos = end
+            return value
+
+
+_decoder = JSONDecoder()
+
+
+def _array_items(stream):
+    # it positions the stream on each element of a JSON array, one at a time
+    stream.expect("[")
+    if stream.peek() == "]":
+        stream.expect("]")
+        return
+    while True:
+        yield
+        if stream.peek() == ",":
+            stream.expect(",")
+        else:
+            stream.expect("]")
+            return
+
+
+def _first_label(label):
+    # IIIF labels are language maps, e.g. {"none": ["Il Canzoniere"]}
+    if not label:
+        return None
+    return list(label.values())[0][0]
+
+
+def _register_entity(frame, ancestors):
+    # it links an entity to all its ancestors, as soon as its id is known:
+    # the links of an ancestor whose id has not been read yet are kept
+    # until it is found
+    frame["depth"] = len(ancestors)
+    for ancestor in ancestors:
+        distance = frame["depth"] - ancestor["depth"]
+        position = ancestor["counts"].get(distance, 0)
+        ancestor["counts"][distance] = position + 1
+        link = ("item", ancestor["id"], frame["id"], distance, position)
+        if ancestor["id"] is None:
+            ancestor["pending"].append(link)
+        else:
+            yield link
+    for link in frame["pending"]:
+        yield ("item", frame["id"]) + link[2:]
+    frame["pending"] = []
+
+
+def _iter_entity(stream, ancestors):
+    depth = len(ancestors)
+    frame = {"id": None, "label": None, "depth": depth, "pending": [], "counts": {}}
+
+    if depth == len(IIIF_LEVELS) - 1:
+        # canvases are the leaves of the tree, so each one is decoded as a whole
+        canvas = stream.value()
+        frame["id"] = canvas.get("id")
+        frame["label"] = _first_label(canvas.get("label"))
+        if frame["id"] is not None:
+            yield from _register_entity(frame, ancestors)
     else:
-        return string
+        stream.expect("{")
+        if stream.peek() == "}":
+            stream.expect("}")
+        else:
+            while True:
+                key = stream.value()
+                stream.expect(":")
+                if key == "items":
+                    for _ in _array_items(stream):
+                        yield from _iter_entity(stream, ancestors + [frame])
+                else:
+                    value = stream.value()
+                    if key == "id":
+                        frame["id"] = value
+                        yield from _register_entity(frame, ancestors)
+                    elif key == "label":
+                        frame["label"] = _first_label(value)
+                if stream.peek() == ",":
+                    stream.expect(",")
+                else:
+                    stream.expect("}")
+                    break
 
+    if frame["id"] is None:
+        raise ValueError(f"{IIIF_LEVELS[depth]} without an id")
+    yield ("entity", frame["id"], IIIF_LEVELS[depth], frame["label"])
 
-def create_graph(json_obj, base_url, graph):
-    # auxiliary function, it creates URI for a graph database
-    collection_id = URIRef(json_obj['id'])
 
-    # defining URIs types
-    type_canvas = URIRef(base_url + 'Canvas')
-    type_collection = URIRef(base_url + 'Collection')
-    type_manifest = URIRef(base_url + 'Manifest')
-    type_metadata = URIRef(base_url + 'Metadata')
+def iter_iiif_events(path, chunk_size=65536):
+    # auxiliary function, it reads a IIIF file containing a collection or
+    # a list of collections incrementally, and yields
+    # ("entity", id, type, label) for each collection, manifest and canvas, and
+    # ("item", ancestor_id, descendant_id, depth, position) for each containment,
+    # where depth 1 means direct child and position is the document order
+    # of the descendant among those of the same depth in the ancestor
+    # only one canvas at a time is held in memory
+    with open(path, mode='r', encoding="utf-8") as j:
+        stream = JsonStream(j, chunk_size)
+        if stream.peek() == "[":
+            for _ in _array_items(stream):
+                yield from _iter_entity(stream, [])
+        else:
+            yield from _iter_entity(stream, [])
 
-    # defining  URIs properties
+
+def iter_collection_triples(events, base_url):
+    # auxiliary function, it yields the triples of the events read
+    # from a IIIF collection file (see iter_iiif_events)
     prop_id = URIRef('https://schema.org/identifier')
-    prop_label = URIRef(base_url + 'label')
     prop_items = URIRef(base_url + 'items')
 
-    # labeling json_obj
-    label_list = list(json_obj['label'].values())
-    label_value = label_list[0][0]
-    label_value = remove_invalid_char(str(label_value))
+    for event in events:
+        if event[0] == "entity":
+            _, entity_id, entity_type, label = event
+            subject = URIRef(entity_id)
+            yield (subject, prop_id, Literal(entity_id))
+            yield (subject, RDF.type, URIRef(base_url + entity_type))
+            if label is not None:
+                yield (subject, RDFS.label, Literal(str(label)))
+        elif event[3] == 1:
+            _, parent_id, child_id, _, _ = event
+            yield (URIRef(parent_id), prop_items, URIRef(child_id))
+
+
+class CollectionIndexWriter(object):
+    # auxiliary class, it stores in the relational database the labels of the
+    # collections, manifests and canvases while their events pass through
+    # watch(), so that they can be searched through LabelSearch, and their
+    # containment closure: one row (ancestor, descendant, depth, position) for
+    # each entity contained, directly or not, in another, plus one row of
+    # depth 0 for each entity itself
+    # the rows of an ancestor already stored are replaced by the new ones
+    # everything is written in one transaction, committed when the `with`
+    # block ends without errors; without a database path it does nothing
+
+    def __init__(self, db_path, batch_size=5000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.con = None
+        self.labels = []
+        self.items = []
+        self.ancestors = set()
+
+    def __enter__(self):
+        if self.db_path is not None:
+            self.con = connect(self.db_path, isolation_level=None)
+            for pragma in BULK_LOAD_PRAGMAS:
+                self.con.execute(pragma)
+            self.con.execute("BEGIN")
+            self.con.execute("CREATE TABLE IF NOT EXISTS Labels ("
+                             "id TEXT PRIMARY KEY, type TEXT, label TEXT)")
+            _create_search_index(self.con, "LabelSearch", "Labels", "label")
+            self.con.execute("CREATE TABLE IF NOT EXISTS Containment ("
+                             "ancestor TEXT, descendant TEXT, depth INTEGER, position INTEGER, "
+                             "PRIMARY KEY (ancestor, descendant)) WITHOUT ROWID")
+            self.con.execute("CREATE INDEX IF NOT EXISTS idx_containment_descendant "
+                             "ON Containment (descendant, depth)")
+        return self
+
+    def watch(self, events):
+        for event in events:
+            if self.con is not None:
+                if event[0] == "entity":
+                    self.labels.append(event[1:])
+                    self.items.append((event[1], event[1], 0, 0))
+                else:
+                    self.items.append(event[1:])
+                if len(self.items) >= self.batch_size:
+                    self._flush()
+            yield event
+
+    def _flush(self):
+        self.con.executemany("INSERT INTO Labels (id, type, label) VALUES (?, ?, ?) "
+                             "ON CONFLICT(id) DO UPDATE SET type = excluded.type, label = excluded.label",
+                             self.labels)
+        # the rows stored by a previous upload for the ancestors met for
+        # the first time are removed before writing the new ones
+        new_ancestors = {item[0] for item in self.items} - self.ancestors
+        self.con.executemany("DELETE FROM Containment WHERE ancestor = ?",
+                             [(ancestor,) for ancestor in new_ancestors])
+        self.ancestors.update(new_ancestors)
+        self.con.executemany("INSERT INTO Containment (ancestor, descendant, depth, position) "
+                             "VALUES (?, ?, ?, ?) ON CONFLICT(ancestor, descendant) DO UPDATE "
+                             "SET depth = excluded.depth, position = excluded.position",
+                             self.items)
+        self.labels = []
+        self.items = []
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.con is None:
+            return False
+        try:
+            if exc_type is None:
+                self._flush()
+                self.con.execute("COMMIT")
+                self.con.execute("ANALYZE Labels")
+                self.con.execute("ANALYZE Containment")
+            else:
+                self.con.execute("ROLLBACK")
+        finally:
+            self.con.close()
+            self.con = None
+        return False
+
+
+class ResultCache(object):
+    # auxiliary class, a thread-safe cache of at most `max_size` results,
+    # dropping the least recently used ones first; a result expires after
+    # `ttl` seconds (None for never) or as soon as the data version it was
+    # computed for is no longer the current one
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        # it returns (True, result) if a valid result is stored for the key,
+        # (False, None) otherwise
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry_version, expires, result = entry
+                if entry_version == version and (expires is None or expires > monotonic()):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, result
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, version, result):
+        if self.max_size < 1:
+            return
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (version, expires, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / requests if requests else 0.0,
+                    "evictions": self.evictions, "size": len(self.entries),
+                    "max_size": self.max_size, "ttl": self.ttl}
 
-    # creating triples 
-    graph.add((collection_id, prop_id, Literal(json_obj['id'])))
-    graph.add((collection_id, RDF.type, type_collection))
-    graph.add((collection_id, RDFS.label, Literal(str(label_value))))
 
-    # populating manifests
-    for manifest in json_obj['items']:
-        manifest_id = URIRef(manifest['id'])
+_QUERY_LITERALS = re.compile(r"""'(?:[^']|'')*'|"(?:[^"\\]|\\.)*"|\b\d+(?:\.\d+)?\b""")
 
-        graph.add((collection_id, prop_items, manifest_id))
-        graph.add((manifest_id, prop_id, Literal(manifest['id'])))
-        graph.add((manifest_id, RDF.type, type_manifest))
-        
-        manifest_label_list = list(manifest['label'].values())
-        manifest_label_value = manifest_label_list[0][0]
-        manifest_label_value = remove_invalid_char(str(manifest_label_value))
 
-        graph.add((manifest_id, RDFS.label, Literal(str(manifest_label_value))))
+def normalize_query(query):
+    # auxiliary function, it returns the text of a SQL or SPARQL query with
+    # its string and number literals replaced by ? and its whitespace collapsed,
+    # so that the same query with different values has the same text
+    return " ".join(_QUERY_LITERALS.sub("?", str(query)).split())
 
-        # populating canvases
-        for canvas in manifest['items']:
-            canvas_id = URIRef(canvas['id'])
 
-            graph.add((manifest_id, prop_items, canvas_id))
-            graph.add((canvas_id, prop_id, Literal(canvas['id'])))
-            graph.add((canvas_id, RDF.type, type_canvas))
+@lru_cache(maxsize=4096)
+def query_signature(query):
+    # auxiliary function, it returns the fingerprint (a short hash identifying
+    # a query regardless of its values) and the normalized text of a query
+    # the same texts (e.g. the SPARQL templates) are sent again and again,
+    # so the results are cached
+    text = normalize_query(query)
+    return sha1(text.encode("utf-8")).hexdigest()[:12], text
 
-            canvas_label_list = list(canvas['label'].values())
-            canvas_label_value = canvas_label_list[0][0]
-            canvas_label_value = remove_invalid_char(str(canvas_label_value))
 
-            graph.add((canvas_id, RDFS.label, Literal(str(canvas_label_value))))
\ No newline at end of file
+def result_rows(result):
+    # auxiliary function, it returns the number of rows or objects in a result
+    if result is None or isinstance(result, bool):
+        return 0
+    if hasattr(result, "__len__"):
+        return len(result)
+    return 1